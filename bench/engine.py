@@ -0,0 +1,200 @@
+#!/usr/bin/python2.7
+"""
+Exercises the socket backend's EngineClient against a stand-in Engine API
+server on a unix socket, checking connection pooling, chunked stream decoding
+and the retry of requests on connections closed by the daemon while idle.
+
+    pool       concurrent requests share at most `pool` keep-alive connections
+    chunked    JSON documents split and combined across chunks are decoded
+    stale      a request on a connection the daemon closed is retried once
+    timeout    a request that timed out waiting for a response is not resent
+
+Usage:
+
+    python bench/engine.py [--requests 200] [--workers 8]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dockerup.engine import EngineClient
+from dockerup.workers import pmap
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def address_string(self):
+        return self.server.path
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, document, status=200):
+        data = json.dumps(document)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Documents written in odd-sized chunks, so they are split across chunk boundaries
+    def send_chunks(self, documents, size=7):
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        payload = '\r\n'.join([json.dumps(document) for document in documents])
+        for offset in range(0, len(payload), size):
+            piece = payload[offset:offset + size]
+            self.wfile.write('%x\r\n%s\r\n' % (len(piece), piece))
+        self.wfile.write('0\r\n\r\n')
+
+    def handle_request(self):
+
+        path = self.path.split('?')[0]
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        self.server.requests.append((self.command, path))
+
+        if path.endswith('/close'):
+            # Respond, then drop the connection as a daemon closing idle connections would
+            self.send_json({})
+            self.server.dropped.append(self.connection)
+        elif path.endswith('/slow'):
+            time.sleep(1)
+            self.send_json({})
+        elif path.endswith('/images/create'):
+            self.send_chunks([{ 'status': 'Pulling %d' % i, 'progress': 'x' * i } for i in range(20)])
+        else:
+            self.send_json({ 'Id': path })
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def handle_one_request(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+        if self.connection in self.server.dropped:
+            self.close_connection = 1
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.path = path
+        self.connections = 0
+        self.requests = []
+        self.dropped = []
+
+    def reset(self):
+        self.connections = 0
+        self.requests = []
+
+    # Clients giving up on a response (the timeout scenario) break the pipe
+    def handle_error(self, request, client_address):
+        pass
+
+def check(name, passed, detail):
+    print('%-10s %-6s %s' % (name, 'ok' if passed else 'FAILED', detail))
+    return passed
+
+def pool(server, url, args):
+
+    client = EngineClient(url, pool=args.workers)
+
+    server.reset()
+    pmap(lambda i: client.call('GET', '/containers/%d/json' % i), range(args.requests), args.workers)
+
+    return check('pool', server.connections <= client.pool and len(server.requests) == args.requests,
+        'requests=%d connections=%d idle=%d' % (len(server.requests), server.connections, client.idle.qsize()))
+
+def chunked(server, url, args):
+
+    client = EngineClient(url)
+
+    server.reset()
+    documents = list(client.stream('POST', '/images/create'))
+    expected = [{ 'status': 'Pulling %d' % i, 'progress': 'x' * i } for i in range(20)]
+
+    return check('chunked', documents == expected, 'documents=%d' % len(documents))
+
+def stale(server, url, args):
+
+    client = EngineClient(url)
+
+    # Leaves the only pooled connection one the daemon has since closed
+    client.call('GET', '/close')
+    time.sleep(0.1)
+
+    server.reset()
+    client.call('POST', '/containers/c1/start')
+
+    return check('stale', [method for (method, path) in server.requests] == ['POST'] and server.connections == 1,
+        'requests=%d connections=%d' % (len(server.requests), server.connections))
+
+def timeout(server, url, args):
+
+    client = EngineClient(url)
+
+    # Pooled connection to make a retry possible
+    client.call('GET', '/version')
+
+    server.reset()
+    try:
+        client.call('POST', '/containers/c1/slow', timeout=0.2)
+        failed = False
+    except socket.timeout:
+        failed = True
+
+    # Let the handler finish before counting requests
+    time.sleep(1.5)
+
+    return check('timeout', failed and len(server.requests) == 1,
+        'timed out=%s requests=%d' % (failed, len(server.requests)))
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Exercise the Engine API client against a stand-in server')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='dockerup-engine-')
+    path = '%s/docker.sock' % workdir
+
+    server = Server(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        results = [scenario(server, 'unix://%s' % path, args) for scenario in (pool, chunked, stale, timeout)]
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python2.7
+"""
+Benchmarks DockerUp.sync() against the in-memory FakeDockerClient backend.
+
+Each scenario runs in a forked process so peak memory (max RSS) is reported per
+scenario. Reported API call counts come from the client's metrics.
+
+    cold     first sync on a fresh host: every image is pulled, every container launched
+    steady   a sync with nothing to do
+    update   a sync after a new version of every image was published
+
+Usage:
+
+    python bench/sync.py [--containers 10,100,500] [--images 100,2000] [--latency 0.001]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dockerup import conf, DockerUp
+from dockerup.fake import FakeDockerClient
+from dockerup.metrics import Metrics
+
+SCENARIOS = ['cold', 'steady', 'update']
+
+def setup(workdir, containers, images, args):
+
+    confdir = '%s/containers.d' % workdir
+    cache = '%s/cache' % workdir
+    logdir = '%s/logs' % workdir
+
+    for directory in (confdir, cache, logdir):
+        os.makedirs(directory)
+
+    docker = FakeDockerClient(args.latency, args.failure_rate, seed=1)
+
+    for i in range(containers):
+
+        entry = { 'type': 'docker', 'name': 'svc-%d' % i, 'image': 'bench/svc-%d:latest' % i }
+
+        # Groups of ten services linked to the first of their group
+        if i % 10:
+            entry['links'] = { 'svc-%d' % (i - i % 10): 'head' }
+
+        with open('%s/svc-%d.json' % (confdir, i), 'w') as local:
+            json.dump(entry, local)
+
+        docker.publish(entry['image'])
+
+    for i in range(images):
+        docker.add_image('bench/filler-%d:latest' % i)
+
+    config = conf.defaults()
+    config.update({
+        'confdir': confdir,
+        'logdir': logdir,
+        'digest_check': False,
+        'image_gc_free': 0,
+        'pull_workers': args.workers,
+        'launch_workers': args.workers,
+        'stop_workers': args.workers
+    })
+
+    return (DockerUp(config, cache, docker), docker)
+
+def measure(up, docker, scenario):
+
+    if scenario != 'cold':
+        up.sync()
+
+    if scenario == 'update':
+        for entry in up.containers:
+            docker.publish(entry['image'])
+
+    docker.metrics = up.metrics = Metrics()
+
+    started = time.time()
+    up.sync()
+    elapsed = time.time() - started
+
+    calls = {}
+    for ((name, labels), value) in docker.metrics.values.items():
+        if name == 'dockerup_docker_call_seconds_count':
+            calls[dict(labels)['call'][len('docker_'):]] = int(value)
+
+    return { 'wall': elapsed, 'calls': calls }
+
+def run(containers, images, scenario, args):
+
+    (read, write) = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read)
+        workdir = tempfile.mkdtemp(prefix='dockerup-bench-')
+        try:
+            (up, docker) = setup(workdir, containers, images, args)
+            result = measure(up, docker, scenario)
+            up.logs.drain()
+            result['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write, json.dumps(result))
+        except:
+            traceback.print_exc()
+        finally:
+            shutil.rmtree(workdir, True)
+            os._exit(0)
+
+    os.close(write)
+
+    output = ''
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        output += chunk
+
+    os.close(read)
+    os.waitpid(pid, 0)
+
+    if not output:
+        raise Exception('Scenario %s failed' % scenario)
+
+    return json.loads(output)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--containers', default='10,100,500', help='Comma-separated container counts')
+    parser.add_argument('--images', default='100,2000', help='Comma-separated unrelated local image counts')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated scenarios')
+    parser.add_argument('--latency', type=float, default=0.001, help='Simulated seconds per Docker API call')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Probability of an injected API failure')
+    parser.add_argument('--workers', type=int, default=4, help='Pull/launch/stop concurrency')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    print '%-10s %6s %6s %9s %9s %10s  %s' % ('scenario', 'conts', 'images', 'wall (s)', 'calls', 'rss (KB)', 'calls by type')
+
+    for containers in [int(c) for c in args.containers.split(',')]:
+        for images in [int(i) for i in args.images.split(',')]:
+            for scenario in args.scenarios.split(','):
+                result = run(containers, images, scenario, args)
+                breakdown = ' '.join(['%s=%s' % c for c in sorted(result['calls'].items())])
+                print '%-10s %6d %6d %9.3f %9d %10d  %s' % (scenario, containers, images, result['wall'],
+                    sum(result['calls'].values()), result['maxrss'], breakdown)
@@ -2,15 +2,27 @@
 
 import os
 import sys
-import shutil
 import json
+import hashlib
 import logging
 import time
 import traceback
 import signal
+import socket
+import threading
+import Queue
+from contextlib import contextmanager
 
 from dockerup import conf
-from dockerup.dockerpy import DockerPyClient
+from dockerup.state import StateStore
+from dockerup.registry import Registry
+from dockerup.schedule import PullScheduler
+from dockerup.logs import LogCollector
+from dockerup.coordinator import FileCoordinator
+from dockerup.plan import Action, Plan
+from dockerup.imagegc import ImageCollector
+from dockerup.trace import Tracer
+from dockerup.workers import pmap
 
 class DockerUp(object):
 
@@ -52,15 +64,47 @@ class DockerUp(object):
     }
     """
 
-    def __init__(self, config, cache):
+    LABEL_NAME = 'dockerup.name'
+    LABEL_DIGEST = 'dockerup.digest'
+    LABEL_MANAGED = 'dockerup.managed'
+
+    def __init__(self, config, cache, docker=None, coordinator=None):
 
         self.config = config
         self.containers = []
+        self.named = {}
+        self.levels = []
+        self.resolver = DependencyResolver([])
+        self.wakeup = Queue.Queue()
+        self.files = conf.FilesConfig(config['confdir']) if 'confdir' in config else None
+        self.userdata = conf.UserData(cache, config['aws_url'])
         self.cache = cache
-        self.docker = DockerPyClient(config['remote'], config['username'], config['password'], config['email'])
+        self.state = StateStore(cache)
+        self.logs = LogCollector(config['logdir'], config['log_gc_rate'])
+        self.scheduler = PullScheduler(self.state, config['pull_backoff'], config['pull_backoff_max'])
+        self.docker = docker or self.client(config)
+        self.metrics = self.docker.metrics
+        self.tracer = self.docker.tracer = Tracer('%s/traces' % cache if config['trace'] else None, config['trace_keep'])
+        # Routine listings only cover containers dockerup launched
+        self.docker.filters = { 'label': ['%s=true' % self.LABEL_MANAGED] }
+        self.coordinator = coordinator or FileCoordinator(config['rolling_dir'] or '%s/rolling' % cache)
+        self.images = ImageCollector(self.docker, self.state, config['image_gc_path'], config['image_gc_free'], config['image_gc_keep'])
 
         self.log = logging.getLogger(__name__)
 
+    def client(self, config):
+
+        # Imported on demand so alternative backends don't require docker-py
+        if config['backend'] == 'socket':
+            from dockerup.engine import SocketClient as Backend
+        elif config['backend'] == 'dockerpy':
+            from dockerup.dockerpy import DockerPyClient as Backend
+        else:
+            raise Exception('Unknown Docker backend: %s' % config['backend'])
+
+        registry = Registry(config['username'], config['password']) if config['digest_check'] else None
+        return Backend(config['remote'], config['username'], config['password'], config['email'], registry)
+
     def pull_allowed(self, entry):
 
         if 'pull' in self.config and not self.config['pull']:
@@ -71,39 +115,48 @@ class DockerUp(object):
 
         return False
 
-    def update(self, entry):
+    # Launch a new container for an entry, replacing the current one if running
+    def launch(self, entry, current):
 
-        if not 'image' in entry:
-            self.log.warn('No image defined for container, skipping')
-            return
+        if 'links' in entry:
+            # Has dependency on another container, wait for it to come up fully
+            # before attempting to launch
+            for link in entry['links'].keys():
+                self.wait_ready(link)
 
-        current = self.status(entry)
-        updated = self.updated(entry)
+        if current['Running']:
+            return self.update_next_window(entry, current)
 
-        if current['Image'] is None or self.pull_allowed(entry):
-            updated = self.docker.pull(entry['image']) or updated
+        return self.update_launch()(entry)
 
-        if updated or not current['Running']:
+    def update_next_window(self, entry, status):
 
-            if 'links' in entry:
-                # Has dependency on another container, let's give Docker time to bring
-                # bring previous container up fully before attempting to launch
-                time.sleep(5)
+        if not 'update' in entry or not 'rolling' in entry['update'] or not entry['update']['rolling']:
+            return self.update_replace(entry, status)
 
-            if current['Running']:
-                return self.update_next_window(entry, current)
-            else:
-                return self.update_launch()(entry)
+        rolling = entry['update']['rolling']
+        if not isinstance(rolling, dict):
+            rolling = {}
 
-        return current
+        service = rolling.get('service') or entry.get('name') or self.repository(entry['image'])
 
-    def update_next_window(self, entry, status):
+        with self.tracer.span('window', service=service):
+            token = self.coordinator.acquire(service, rolling.get('limit', 1), rolling.get('timeout', 600))
 
-        if 'update' in entry and 'rolling' in entry['update'] and entry['update']['rolling']:
-            # TODO use central coordinator service to wait for available update window
-            log.warn('Rolling updates not yet supported')
+        if token is None:
+            # Never hold back updates indefinitely
+            self.log.warn('Timed out waiting for update window for %s, updating anyway' % service)
 
-        return self.update_replace(entry, status)
+        try:
+            status = self.update_replace(entry, status)
+            # Keep the window until the replacement is ready to take traffic, unless
+            # it failed to launch and there is nothing to wait for
+            if status['Id']:
+                self.wait_ready(entry.get('name') or status['Id'], entry.get('ready', {}))
+            return status
+        finally:
+            if token is not None:
+                self.coordinator.release(token)
 
     # Eager update: start new container first (primarily to facilitate self-upgrade
     # of the dockerup management container itself)
@@ -112,13 +165,13 @@ class DockerUp(object):
         if 'update' in entry and 'eager' in entry['update'] and entry['update']['eager']:
 
             if 'name' in entry:
-                log.warn('Skipping eager update due to container name conflict')
+                self.log.warn('Skipping eager update due to container name conflict')
                 return False
 
             if 'portMappings' in entry:
                 for mapping in entry['portMappings']:
                     if 'hostPort' in mapping:
-                        log.warn('Skipping eager update due to host port conflict')
+                        self.log.warn('Skipping eager update due to host port conflict')
                         return False
 
             return True
@@ -127,17 +180,61 @@ class DockerUp(object):
 
     def update_replace(self, entry, status):
 
+        self.metrics.inc('dockerup_replacements_total')
+
+        if self.is_standby(entry):
+            return self.update_standby(entry, status)
+
         if self.is_eager(entry):
             return self.update_launch(self.update_stop(status))(entry)
 
         return self.update_stop(status, self.update_launch())(entry)
 
+    def is_standby(self, entry):
+        return 'update' in entry and 'standby' in entry['update'] and entry['update']['standby'] \
+            and entry.get('type', 'docker') == 'docker'
+
+    # Standby update: create the new container under a temporary name while the old
+    # one is still running, leaving only stop, rename and start in the downtime window
+    def update_standby(self, entry, status):
+
+        name = entry.get('name')
+        standby = '%s-next' % name if name else None
+
+        if standby:
+            # Leftover from an interrupted update
+            leftover = self.docker.inspect(standby)
+            if leftover:
+                self.docker.stop(leftover['Id'])
+
+        self.log.debug('Creating standby container')
+        container = self.docker.create(dict(self.stamp(entry), name=standby) if standby else self.stamp(entry))
+
+        if not container:
+            self.log.warn('Could not create standby container, replacing normally')
+            return self.update_stop(status, self.update_launch())(entry)
+
+        # Stop all dependencies, they will get updated/restarted
+        self.stop_dependencies(entry)
+        self.update_stop(status)(entry)
+
+        if standby and not self.docker.rename(container, name):
+            # The old container is already gone, launch normally rather than leave
+            # the service down
+            self.log.warn('Could not rename standby container, launching normally')
+            self.docker.rm(container)
+            return self.update_launch()(entry)
+
+        self.docker.start(container, entry)
+
+        return self.status(entry)
+
     def update_stop(self, status, callback=None):
 
         def actual(entry):
 
             self.log.debug('Stopping old container: %s' % status['Id'])
-            self.stop(status)
+            self.stop(status, entry=entry)
 
             if callback:
                 return callback(entry)
@@ -158,9 +255,6 @@ class DockerUp(object):
                     self.stop_dependencies(entry)
                     self.log.debug('Starting new container')
                     self.run(entry)
-                    if 'signal' in entry:
-                        for target in entry['signal'].keys():
-                            self.docker_signal(target, entry['signal'][target])
                     status = self.status(entry)
                 except Exception as e:
                     self.log.error('Could not run container: %s' % e)
@@ -174,10 +268,18 @@ class DockerUp(object):
 
         return actual
 
-    def status(self, entry):
+    def status(self, entry, image=None):
 
-        image = self.docker.image(entry['image'])
-        container = self.docker.container(image['Id']) if image else None
+        if image is None:
+            image = self.docker.image(entry['image'])
+
+        container = None
+
+        if image:
+            # Prefer a running container over stopped ones (e.g. an unstarted standby)
+            containers = self.docker.containers_for(image['Id'])
+            running = [c for c in containers if c['Running']]
+            container = (running or containers or [None])[0]
 
         return {
             'Id': container['Id'] if container else None,
@@ -186,24 +288,68 @@ class DockerUp(object):
             'Running': container['Running'] if container else False
         }
 
-    def updated(self, entry):
+    # Wait until a named container is running and passes its optional readiness
+    # checks (by default those configured for it), giving up after their timeout
+    def wait_ready(self, name, ready=None):
 
-        updated = False
+        if ready is None:
+            ready = self.named.get(name, {}).get('ready', {})
 
-        cachefile = '%s/%s.json' % (self.cache, self.__cache_name(entry))
+        deadline = time.time() + float(ready.get('timeout', 30))
 
-        if os.path.exists(cachefile):
-            with open(cachefile) as local:
-                if json.dumps(entry) != local.read():
-                    updated = True
-        else:
-            updated = True
+        while not self.ready(name, ready):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.log.warn('Timed out waiting for container to become ready: %s' % name)
+                return False
+            time.sleep(min(float(ready.get('interval', 0.5)), remaining))
+
+        return True
+
+    def ready(self, name, checks):
+
+        container = self.docker.inspect(name)
+
+        if not container or not container['Running']:
+            return False
+
+        if 'port' in checks:
+            try:
+                conn = socket.create_connection((container['IPAddress'] or '127.0.0.1', int(checks['port'])), 1)
+                conn.close()
+            except Exception as e:
+                self.log.debug('Port check failed for %s: %s' % (name, e))
+                return False
+
+        if 'command' in checks:
+            if self.docker.execute(container['Id'], checks['command']) != 0:
+                self.log.debug('Health command failed for %s' % name)
+                return False
+
+        return True
 
-        if updated:
-            with open(cachefile, 'w') as local:
-                json.dump(entry, local)
+    # Check whether an entry differs from the configuration its container was
+    # launched from, without recording it
+    def changed(self, entry):
 
-        return updated
+        name = self.__cache_name(entry)
+        digest = self.digest(entry)
+        cached = self.state.get(name)
+
+        if cached is None:
+            # No local state (first run or lost cache dir), fall back to the labels
+            # stamped on containers launched from this entry
+            for container in self.docker.labeled(self.LABEL_NAME, name):
+                if container['Labels'].get(self.LABEL_DIGEST) == digest:
+                    self.log.debug('Recovered cached configuration from labels: %s' % name)
+                    return False
+            return True
+
+        return self.digest(cached) != digest
+
+    # Canonical configuration digest, independent of key order and formatting
+    def digest(self, entry):
+        return hashlib.sha1(json.dumps(entry, sort_keys=True, separators=(',', ':'))).hexdigest()
 
     def __cache_name(self, entry):
 
@@ -219,70 +365,292 @@ class DockerUp(object):
         if 'type' in config and config['type'] != 'docker':
             return False
 
-        return self.docker.run(config)
+        return self.docker.run(self.stamp(config))
 
-    def stop(self, status, remove=True):
-        self.docker.stop(status['Id'], remove)
+    # Stamp identity and config digest so state can be rebuilt from Docker alone
+    def stamp(self, config):
 
-    # Shutdown containers with unrecognized images to avoid resource conflicts
-    def shutdown_unknown(self, entries=None):
+        labels = dict(config.get('labels', {}))
+        labels[self.LABEL_NAME] = self.__cache_name(config)
+        labels[self.LABEL_DIGEST] = self.digest(config)
+        labels[self.LABEL_MANAGED] = 'true'
 
-        existing = []
-        catalog = []
+        return dict(config, labels=labels)
 
-        def cached_entry(cached):
-            cachefile = '%s/%s' % (self.cache, cached)
-            with open(cachefile) as local:
-                return json.load(local)
+    def stop(self, status, remove=True, entry=None):
+        self.docker.stop(status['Id'], remove, self.stop_timeout(entry))
 
-        if entries:
-            catalog.extend(entries)
+    # Seconds to wait for a graceful stop before Docker kills the container
+    def stop_timeout(self, entry=None):
 
-        catalog.extend([cached_entry(cf) for cf in os.listdir(self.cache) if cf.endswith('.json')])
+        if entry and 'stopTimeout' in entry:
+            return int(entry['stopTimeout'])
 
-        for entry in catalog:
-            status = self.status(entry)
-            if status['Id']:
-                existing.append(status['Id'])
+        return int(self.config['stop_timeout'])
+
+    # Stop (and remove) containers concurrently, given (status, entry) pairs
+    def stop_all(self, targets):
+        pmap(lambda (status, entry): self.stop(status, entry=entry), targets, self.config['stop_workers'])
+
+    # Minimum seconds between pulls for an entry's image (0 pulls every sync)
+    def pull_interval(self, entry):
+
+        if 'update' in entry and 'pullInterval' in entry['update']:
+            return float(entry['update']['pullInterval'])
+
+        return 0
+
+    # Diff the configuration against a single snapshot of Docker state, producing
+    # the stops, pulls and launches needed to reconcile them
+    def plan(self):
+
+        plan = Plan()
+        desired = dict([(self.__cache_name(entry), entry) for entry in self.containers if 'image' in entry])
+        statuses = {}
+        claimed = set()
+
+        # Full scan, including containers dockerup doesn't manage
+        plan.scanned = self.docker.scan()
+
+        known = desired.values() + self.state.values()
+        names = set(['/%s' % entry['name'] for entry in known if 'name' in entry])
+        repositories = set([self.repository(entry['image']) for entry in known])
+
+        # Containers launched before managed labels were introduced are adopted into
+        # the managed listing if they use a configured name or image repository
+        self.docker.containers()
+        for container in plan.scanned:
+            if not self.managed(container) and self.owned(container, names, repositories):
+                self.docker.cache_container(container)
+
+        for (name, entry) in desired.items():
+            statuses[name] = self.status(entry)
+            if statuses[name]['Id']:
+                claimed.add(statuses[name]['Id'])
+
+        # Leftover containers from old configurations
+        for (name, cached) in self.state.items():
+            if not name in desired:
+                status = self.status(cached)
+                if status['Id'] and not status['Id'] in claimed:
+                    plan.add(Action('stop' if status['Running'] else 'remove', cached, status, reason='configuration removed'))
+                    claimed.add(status['Id'])
+                plan.forget.append(name)
+
+        # Rare occurence, dockerup containers that match no configuration. Usually due
+        # to manual updates, may be required to avoid port binding conflicts
+        for container in plan.scanned:
+            if container['Running'] and not container['Id'] in claimed:
+                if self.managed(container) or self.owned(container, names, repositories):
+                    plan.add(Action('stop', status={ 'Id': container['Id'] }, reason='unknown container'))
+
+        # Images to pull, at the shortest interval requested by any entry using them
+        images = []
+        for entry in self.containers:
+            if entry.get('image') and (self.pull_allowed(entry) or statuses[self.__cache_name(entry)]['Image'] is None):
+                if not entry['image'] in plan.intervals:
+                    images.append(entry['image'])
+                plan.intervals[entry['image']] = min(plan.intervals.get(entry['image'], float('inf')), self.pull_interval(entry))
+
+        due = []
+
+        for image in images:
+            plan.previous[image] = self.docker.image(image)
+            if self.scheduler.due(image):
+                due.append(image)
+            else:
+                plan.deferred.append(image)
+
+        # Images whose registry digest matches the local image don't need a pull
+        for (image, current) in zip(due, pmap(self.docker.current, due, self.config['pull_workers'])):
+            if current:
+                plan.current.append(image)
+            else:
+                plan.add(Action('pull', target=image))
+
+        pulling = set([action.target for action in plan.of('pull')])
+        restarts = {}
+
+        # Containers are launched level by level; containers within a level don't
+        # depend on each other
+        for (level, group) in enumerate(self.levels):
+
+            for entry in group:
+                if 'image' in entry:
+                    self.plan_entry(plan, entry, statuses[self.__cache_name(entry)], level, pulling, restarts)
+
+        return plan
+
+    # Add the actions needed to bring a single entry in line, given its current status,
+    # the images being pulled and the conditions under which dependents get restarted
+    def plan_entry(self, plan, entry, status, level=0, pulling=(), restarts=None):
+
+        name = self.__cache_name(entry)
+        changed = self.changed(entry)
+        restarts = restarts if restarts is not None else {}
+
+        if changed or self.state.get(name) is None:
+            plan.remember.append((name, entry))
+
+        if status['Image'] is None:
+            action = Action('create', entry, status, reason='image missing')
+        elif changed:
+            action = Action('replace' if status['Running'] else 'create', entry, status, reason='configuration changed')
+        elif not status['Running']:
+            action = Action('create', entry, status, reason='not running')
+            if status['Id'] and not entry['image'] in pulling and self.launched(entry, status):
+                action.kind = 'start'
+        else:
+            conditions = None
+            if entry['image'] in pulling:
+                conditions = [entry['image']]
+            if name in restarts:
+                conditions = self.merge_conditions(conditions, restarts[name])
+            if conditions is None:
+                return None
+            action = Action('replace', entry, status, reason='image update' if entry['image'] in pulling else 'linked container restarted', conditions=conditions)
+
+        if action.kind == 'create' and status['Id']:
+            # Stopped container would conflict with the new one's name
+            plan.add(Action('remove', entry, status, reason='replaced by new container'))
+
+        action.level = level
+        plan.add(action)
+
+        if 'signal' in entry:
+            for target in entry['signal'].keys():
+                plan.add(Action('signal', entry, target=target, conditions=action.conditions, level=level))
+
+        # Launching stops downstream containers, named or not, they need to be restarted
+        if 'name' in entry and action.kind != 'start':
+            for dependent in self.resolver.downstream(entry['name']):
+                if 'image' in dependent:
+                    key = self.__cache_name(dependent)
+                    restarts[key] = self.merge_conditions(restarts.get(key), action.conditions)
+
+        return action
 
-        self.log.debug('Cleaning up orphaned containers')
+    def managed(self, container):
+        return (container.get('Labels') or {}).get(self.LABEL_MANAGED) == 'true'
 
-        # Iterate through running containers and stop them if they don't match a cached config
-        [self.docker.stop(c['Id']) for c in self.docker.containers() if c['Running'] and not c['Id'] in existing]
+    # Whether an unlabeled container uses one of the given names or image repositories
+    def owned(self, container, names, repositories):
+        return len(names.intersection(container['Names'])) > 0 or \
+            len(repositories.intersection(self.image_repositories(container))) > 0
 
-        # Remove old log files from last run shutdown (gives logstash some time to process final messages)
-        ids = [c['Id'] for c in self.docker.containers() if c['Running']]
-        if os.path.exists('/var/log/ext'):
-            for entry in os.listdir('/var/log/ext'):
-                if os.path.isdir('/var/log/ext/%s' % entry) and entry not in ids:
-                    self.log.info('Removing old logs for %s' % entry)
-                    shutil.rmtree('/var/log/ext/%s' % entry)
+    # Repositories of the image a container runs. Once its tag has moved to a newer
+    # image, a container only lists the image ID, so the repository is resolved
+    # through the image's remaining references or the image it was created from
+    def image_repositories(self, container):
 
-    # Shutdown leftover containers from old configurations
-    def cleanup(self, valid):
+        # Image is unresolved when the listing names a reference missing from the image
+        # index (e.g. "ubuntu" for ubuntu:latest), which is then used as is
+        if not container['Image'] or self.docker.short_id(container['Tag']) != self.docker.short_id(container['Image']):
+            return set([self.repository(container['Tag'])])
 
-        self.log.debug('Cleaning up missing configurations')
+        image = self.docker.image(id=container['Image']) or {}
+        references = [tag for tag in image.get('RepoTags') or [] if not tag.startswith('<none>')]
+        references += [digest.split('@', 1)[0] for digest in image.get('RepoDigests') or [] if not digest.startswith('<none>')]
 
-        for entry in os.listdir(self.cache):
+        if not references:
+            # Untagged image, don't add an unrelated container to the managed listing
+            record = self.docker.inspect(container['Id'], cache=False)
+            if record and record['Tag']:
+                references = [record['Tag']]
 
-            if not entry.endswith('.json'):
-                continue
+        return set([self.repository(reference) for reference in references])
 
-            cachefile = '%s/%s' % (self.cache, entry)
+    # Image reference without its tag
+    def repository(self, image):
 
-            with open(cachefile) as local:
-                cached = json.load(local)
+        if ':' in image.rsplit('/', 1)[-1]:
+            return image.rsplit(':', 1)[0]
 
-            status = self.status(cached)
+        return image
 
-            if status['Id'] and not status['Id'] in valid:
-                os.unlink(cachefile)
-                self.stop(status)
+    # Combine action conditions: None (no action), [] (always) or a list of images
+    def merge_conditions(self, a, b):
+
+        if a is None or b is None:
+            return b if a is None else a
+
+        if not len(a) or not len(b):
+            return []
+
+        return sorted(set(a) | set(b))
+
+    # Check whether a stopped container was launched from an entry's current configuration
+    def launched(self, entry, status):
+        container = self.docker.container(id=status['Id'])
+        return container is not None and container.get('Labels', {}).get(self.LABEL_DIGEST) == self.digest(entry)
+
+    # Execute a plan in batches: stops, then pulls, then launches level by level
+    def execute(self, plan):
+
+        with self.phase('stop'):
+
+            self.stop_all([(action.status, action.entry) for action in plan.of('stop')])
+            pmap(lambda action: self.docker.rm(action.status['Id']), plan.of('remove'), self.config['stop_workers'])
+
+            for name in plan.forget:
+                self.state.delete(name)
+            for (name, entry) in plan.remember:
+                self.state.put(name, entry)
+
+            # Remove old log files from last run shutdown (gives logstash some time to process final messages)
+            self.logs.collect([c['Id'] for c in plan.scanned if c['Running']])
+
+        with self.phase('pulls'):
+            self.pull_images(plan)
+
+        with self.phase('updates'):
+            for level in plan.levels():
+                pmap(lambda action: self.apply(plan, action), level, self.config['launch_workers'])
+
+    # Pull all planned images concurrently, recording results on the plan
+    def pull_images(self, plan):
+
+        for image in plan.deferred:
+            self.metrics.inc('dockerup_pulls_total', { 'result': 'deferred' })
+
+        for image in plan.current:
+            self.log.debug('Image is up to date: %s' % image)
+            self.metrics.inc('dockerup_pulls_total', { 'result': 'digest_current' })
+            self.scheduler.record(image, False, plan.intervals[image])
+
+        def pull(image):
+            result = self.docker.pull(image, False)
+            self.scheduler.record(image, result, plan.intervals[image])
+            return result
+
+        images = [action.target for action in plan.of('pull')]
+        plan.results = dict(zip(images, pmap(pull, images, self.config['pull_workers'])))
+
+    # Execute a single launch action and the signals that follow it
+    def apply(self, plan, action):
+
+        entry = action.entry
+
+        if not plan.applies(action):
+            self.log.debug('Image not updated, keeping container: %s' % entry['image'])
+            return
+
+        with self.tracer.span('update', image=entry['image'], container=entry.get('name')):
+
+            if action.kind == 'start':
+                self.docker.start(action.status['Id'], entry)
+            else:
+                # Status must reflect the pre-pull image so the running container is replaced
+                self.launch(entry, self.status(entry, plan.previous.get(entry['image'])))
+
+            for signal in plan.signals(action):
+                self.docker.signal(signal.target, entry['signal'][signal.target])
 
     def update_config(self):
 
         config = {}
         containers = []
+        changed = not len(self.containers)
 
         def merge(cfg):
             if 'containers' in cfg:
@@ -290,41 +658,164 @@ class DockerUp(object):
                 del cfg['containers']
             config.update(cfg)
 
-        if 'confdir' in self.config:
-            merge(conf.files_config(self.config['confdir']))
+        if self.files:
+            (cfg, files_changed) = self.files.load()
+            changed = changed or files_changed
+            merge(cfg)
 
         if 'aws' in self.config and self.config['aws']:
-            merge(conf.aws_config())
+            (cfg, aws_changed) = self.userdata.load()
+            changed = changed or aws_changed
+            merge(cfg)
+
+        # Reuse the resolved container list until something changes
+        if changed:
+            self.resolver = DependencyResolver(containers)
+            self.containers = self.resolver.resolve()
+            self.named = dict([(c['name'], c) for c in self.containers if 'name' in c])
+            self.levels = self.resolver.levels()
 
-        self.containers = DependencyResolver(containers).resolve()
         self.config.update(config)
 
     def stop_dependencies(self, entry):
         if 'name' in entry:
-            for container in DependencyResolver(self.containers).downstream(entry['name']):
+            targets = []
+            for container in self.resolver.downstream(entry['name']):
                 status = self.status(container)
                 if status['Id']:
                     self.log.info('Dependent container %s will be restarted to maintain link consistency' % status['Id'])
-                    self.stop(status)
+                    targets.append((status, container))
+            self.stop_all(targets)
 
     # Run a single sync cycle
     def sync(self):
 
+        try:
+            with self.metrics.timer('dockerup_sync_seconds'), self.tracer.span('sync'):
+                self.sync_phases()
+        finally:
+            self.tracer.flush()
+
+        self.metrics.set('dockerup_last_sync_timestamp_seconds', time.time())
+
+    @contextmanager
+    def phase(self, name):
+        with self.metrics.timer('dockerup_sync_phase_seconds', { 'phase': name }), self.tracer.span(name):
+            yield
+
+    def sync_phases(self):
+
         # Update container config
+        with self.phase('update_config'):
+            self.update_config()
+
+        with self.phase('plan'):
+            plan = self.plan()
+
+        self.execute(plan)
+
+        with self.phase('cleanup'):
+
+            # Remove unused containers/images from Docker; dangling images are left to
+            # the image collector if enabled, they may be kept for rollback
+            self.docker.cleanup(images=not self.images.enabled())
+
+            # Evict old images if disk space is running low
+            self.images.touch(set([c['Image'] for c in self.docker.containers() if c['Running'] and c['Image']]))
+            self.images.collect()
+
+        self.state.save()
+
+    # Show the actions the next sync would take, without changing anything
+    def dry_run(self):
         self.update_config()
+        return str(self.plan())
+
+    # Bring a single entry back in line after a Docker event, without pulling
+    def reconcile(self, entry):
+
+        self.log.info('Reconciling container: %s' % entry['image'])
 
-        # Rare occurence, kill containers that have an unknown image tag
-        # Usually due to manual updates, may be required to avoid port binding conflicts
-        self.shutdown_unknown(self.containers)
+        # The event that queued this entry may not have reached the cache yet, plan
+        # against a fresh record of its container
+        status = self.status(entry)
+        if status['Id']:
+            self.docker.update_container(status['Id'])
+            status = self.status(entry)
+
+        # Planned like a sync, so a stopped container is restarted (or removed
+        # before it is recreated) rather than conflicting with its replacement
+        plan = Plan()
+        self.plan_entry(plan, entry, status)
+
+        for action in plan.of('remove'):
+            self.docker.rm(action.status['Id'])
+        for (name, cached) in plan.remember:
+            self.state.put(name, cached)
+        for action in plan.of('create', 'start', 'replace'):
+            self.apply(plan, action)
+
+        self.state.save()
+
+    # Sleep until the next full sync, handling targeted wakeups in the meantime.
+    # Queued entries are reconciled individually, None forces an early full sync.
+    def wait(self, timeout):
+
+        deadline = time.time() + timeout
+
+        while True:
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+
+            try:
+                entry = self.wakeup.get(True, remaining)
+            except Queue.Empty:
+                return
+
+            if entry is None:
+                return
 
-        # Process configuration and store running container IDs
-        running = [self.update(container)['Id'] for container in self.containers]
+            try:
+                self.reconcile(entry)
+            except Exception as e:
+                self.log.error('Error reconciling container: %s' % e.message)
+                self.log.debug(traceback.format_exc())
 
-        # Cleanup containers with no config
-        self.cleanup(running)
+    # Find configured entries affected by a Docker event
+    def affected(self, event):
 
-        # Remove unused containers/images from Docker
-        self.docker.cleanup()
+        affected = []
+
+        for entry in self.containers:
+            if 'image' in entry:
+                status = self.status(entry)
+                if event['id'] in (status['Id'], status['Image']):
+                    affected.append(entry)
+
+        return affected
+
+    # Follow the Docker event stream, queueing entries whose containers died,
+    # were removed or lost their image tag
+    def watch_events(self):
+
+        while True:
+
+            try:
+                for event in self.docker.events():
+                    # Resolved against cache state from before this event is applied
+                    if event.get('status') in ('die', 'destroy'):
+                        for entry in self.affected(event):
+                            self.wakeup.put(entry)
+                    elif event.get('status') == 'untag' and len(self.affected(event)):
+                        # Running container may now look orphaned, needs a full sync
+                        self.wakeup.put(None)
+            except Exception as e:
+                self.log.error('Docker event stream failed: %s' % e)
+                self.log.debug(traceback.format_exc())
+
+            time.sleep(1)
 
     def start(self):
 
@@ -332,6 +823,22 @@ class DockerUp(object):
 
             signal.signal(signal.SIGTERM, self.handle_signal)
 
+            if self.config['metrics_port']:
+                self.metrics.serve(self.config['metrics_port'])
+
+            # Config edits trigger an immediate sync
+            if self.files:
+                self.files.watch(lambda: self.wakeup.put(None), float(self.config['watch_interval']))
+
+            # As do user-data changes, which are fetched in the background
+            if 'aws' in self.config and self.config['aws']:
+                self.userdata.watch(lambda: self.wakeup.put(None), float(self.config['aws_interval']))
+
+            if 'events' in self.config and self.config['events']:
+                watcher = threading.Thread(target=self.watch_events, name='events')
+                watcher.daemon = True
+                watcher.start()
+
             # TODO connect to control queue (SQS?) for update broadcasts
             while True:
 
@@ -345,7 +852,7 @@ class DockerUp(object):
 
                     # Separate sleep from sync loop to prevent logspam
                     self.log.info('Config: %s' % self.config['interval'])
-                    time.sleep(float(self.config['interval']))
+                    self.wait(float(self.config['interval']))
 
                 except Exception as e:
                     self.log.error('Error in sync loop: %s' % e.message)
@@ -353,6 +860,9 @@ class DockerUp(object):
 
         else:
             self.sync()
+            self.logs.drain()
+            if self.config['metrics_file']:
+                self.metrics.write(self.config['metrics_file'])
 
     def handle_signal(self, signo, stack):
         self.log.info('Received signal %s, shutting down' % signo)
@@ -364,6 +874,12 @@ class DockerUp(object):
 
 class DependencyResolver(object):
 
+    """
+    Orders container entries by their links, volumes-from and network container
+    dependencies. Dependencies and their reverse are indexed once, so the sort is
+    linear and downstream lookups only visit the containers actually affected.
+    """
+
     def __init__(self, containers):
 
         self.containers = containers
@@ -405,36 +921,74 @@ class DependencyResolver(object):
                     if target in self.named:
                         node.depend(self.named[target])
 
+        self.order = self.walk()
+        self.position = dict([(node, i) for (i, node) in enumerate(self.order)])
+
     # Return dependency-sorted list
     def resolve(self):
-        return [r.container for r in self.walk(self.root, [], [])]
+        return [r.container for r in self.order]
 
-    # Return a list of containers that depend on a named container (directly or indirectly)
+    # Return dependency-sorted groups; each group only depends on earlier groups
+    def levels(self):
+
+        depth = {}
+        levels = []
+
+        for node in self.order:
+            depth[node] = 1 + max([depth[dep] for dep in node.deps] + [-1])
+            if depth[node] == len(levels):
+                levels.append([])
+            levels[depth[node]].append(node.container)
+
+        return levels
+
+    # Return the containers that depend on a named container (directly or indirectly),
+    # each once, most distant dependents first
     def downstream(self, name):
-        deps = []
-        if name in self.named:
-            node = self.named[name]
-            for d in self.root.deps:
-                if node in d.deps:
-                    if 'name' in d.container:
-                        deps.extend(self.downstream(d.container['name']))
-                    deps.append(d.container)
-        return deps
-
-    def walk(self, node, resolved, seen):
-
-        seen.append(node)
-
-        for dep in node.deps:
-            if dep not in resolved:
-                if dep in seen:
+
+        if not name in self.named:
+            return []
+
+        found = set()
+        pending = [self.named[name]]
+
+        while pending:
+            for dependent in pending.pop().dependents:
+                if dependent.container and not dependent in found:
+                    found.add(dependent)
+                    pending.append(dependent)
+
+        return [node.container for node in sorted(found, key=self.position.get, reverse=True)]
+
+    # Depth-first topological sort, iterative to avoid recursion limits on long chains
+    def walk(self):
+
+        resolved = []
+        done = set()
+        active = set()
+        stack = [(self.root, iter(self.root.deps))]
+
+        while stack:
+
+            (node, deps) = stack[-1]
+
+            for dep in deps:
+                if dep in done:
+                    continue
+                if dep in active:
                     raise Exception('Circular dependency reference detected: %s -> %s'
                         % (node.container['image'], dep.container['image']))
-                self.walk(dep, resolved, seen)
+                active.add(dep)
+                stack.append((dep, iter(dep.deps)))
+                break
 
-        # Skip root node
-        if node.container:
-            resolved.append(node)
+            else:
+                stack.pop()
+                active.discard(node)
+                done.add(node)
+                # Skip root node
+                if node.container:
+                    resolved.append(node)
 
         return resolved
 
@@ -443,6 +997,13 @@ class DependencyNode(object):
     def __init__(self, container=None):
         self.container = container
         self.deps = []
+        self.edges = set()
+        self.dependents = []
 
     def depend(self, node):
-        self.deps.append(node)
+        if not node in self.edges:
+            self.edges.add(node)
+            self.deps.append(node)
+            # The root depends on everything, it is nobody's dependent
+            if self.container is not None:
+                node.dependents.append(self)
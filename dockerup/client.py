@@ -3,31 +3,227 @@
 import logging
 import abc
 import traceback
+import threading
+import time
+
+from dockerup.metrics import Metrics
+from dockerup.trace import Tracer
 
 class DockerClient(object):
 
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    IMAGE_EVENTS = ('untag', 'delete', 'tag', 'pull', 'import')
+    CONTAINER_EVENTS = ('create', 'start', 'restart', 'die', 'kill', 'stop', 'pause', 'unpause', 'rename')
+
+    def __init__(self, registry=None, filters=None):
+
+        # Optional registry client for cheap "is the tag still current" checks
+        self.registry = registry
+
+        # Server-side filters for the cached container listing
+        self.filters = filters
+
+        # Cached listings, None until loaded
+        self.image_cache = None
+        self.container_cache = None
 
-        self.image_cache = []
-        self.container_cache = []
+        # Guards caches and indexes, which may be updated from worker threads
+        self.lock = threading.RLock()
+
+        # Lookup indexes, rebuilt whenever the matching cache is replaced
+        self.image_tags = {}
+        self.image_ids = {}
+        self.image_short_ids = {}
+        self.container_ids = {}
+        self.image_containers = {}
+        self.label_containers = {}
 
         self.log = logging.getLogger(__name__)
 
+        # Time (and optionally trace) every backend call
+        self.metrics = Metrics()
+        self.tracer = Tracer()
+        for name in [n for n in dir(self) if n.startswith('docker_')]:
+            setattr(self, name, self.instrument(name, getattr(self, name)))
+
+    def instrument(self, name, fn):
+
+        def call(*args, **kwargs):
+            started = time.time()
+            try:
+                with self.tracer.span(name):
+                    return fn(*args, **kwargs)
+            except:
+                self.metrics.inc('dockerup_docker_errors_total', { 'call': name })
+                raise
+            finally:
+                self.metrics.observe('dockerup_docker_call_seconds', time.time() - started, { 'call': name })
+
+        return call
+
     def flush_images(self):
-        self.image_cache = []
+        self.set_images(None)
 
     def flush_containers(self):
-        self.container_cache = []
+        self.set_containers(None)
 
     def flush(self):
         self.flush_images()
         self.flush_containers()
 
     def refresh(self):
-        self.image_cache = self.docker_images()
-        self.container_cache = self.docker_containers()
+        self.set_images(self.docker_images())
+        self.set_containers(self.docker_containers())
+
+    def set_images(self, images):
+
+        tags = {}
+        ids = {}
+        short_ids = {}
+
+        for image in images or []:
+            ids[image['Id']] = image
+            short_ids[self.short_id(image['Id'])] = image
+            for tag in image['RepoTags'] or []:
+                # First match wins, same as a linear scan would
+                tags.setdefault(tag, image)
+
+        with self.lock:
+            self.image_cache = images
+            self.image_tags = tags
+            self.image_ids = ids
+            self.image_short_ids = short_ids
+
+    def set_containers(self, containers):
+
+        ids = {}
+        by_image = {}
+        by_label = {}
+
+        for container in containers or []:
+            ids[container['Id']] = container
+            by_image.setdefault(container['Image'], []).append(container)
+            for label in (container.get('Labels') or {}).items():
+                by_label.setdefault(label, []).append(container)
+
+        with self.lock:
+            self.container_cache = containers
+            self.container_ids = ids
+            self.image_containers = by_image
+            self.label_containers = by_label
+
+    # Write-through cache maintenance. Records are only patched into caches that
+    # are already loaded; an unloaded cache is fetched in full on next access anyway.
+
+    def cache_image(self, image):
+
+        with self.lock:
+
+            if self.image_cache is None or image is None:
+                return
+
+            self.uncache_image(image['Id'])
+
+            # Tags move to the new image, leaving the old one untagged
+            for tag in image['RepoTags'] or []:
+                previous = self.image_tags.get(tag)
+                if previous and tag in (previous['RepoTags'] or []):
+                    previous['RepoTags'] = [t for t in previous['RepoTags'] if t != tag]
+                self.image_tags[tag] = image
+
+            self.image_cache.insert(0, image)
+            self.image_ids[image['Id']] = image
+            self.image_short_ids[self.short_id(image['Id'])] = image
+
+    def uncache_image(self, id):
+
+        with self.lock:
+
+            image = self.image_ids.pop(id, None)
+            if image is None:
+                return
+
+            self.image_cache.remove(image)
+            self.image_short_ids.pop(self.short_id(id), None)
+
+            for tag in image['RepoTags'] or []:
+                if self.image_tags.get(tag) is image:
+                    del self.image_tags[tag]
+
+    def cache_container(self, container):
+
+        with self.lock:
+
+            if self.container_cache is None or container is None:
+                return
+
+            self.uncache_container(container['Id'])
+
+            self.container_cache.insert(0, container)
+            self.container_ids[container['Id']] = container
+            self.image_containers.setdefault(container['Image'], []).insert(0, container)
+            for label in (container.get('Labels') or {}).items():
+                self.label_containers.setdefault(label, []).insert(0, container)
+
+    def uncache_container(self, id):
+
+        with self.lock:
+
+            container = self.container_ids.pop(id, None)
+            if container is None:
+                return
+
+            self.container_cache.remove(container)
+
+            siblings = self.image_containers.get(container['Image'], [])
+            siblings.remove(container)
+            if not len(siblings):
+                del self.image_containers[container['Image']]
+
+            for label in (container.get('Labels') or {}).items():
+                siblings = self.label_containers.get(label, [])
+                siblings.remove(container)
+                if not len(siblings):
+                    del self.label_containers[label]
+
+    # Refresh a single container record from Docker
+    def update_container(self, container):
+        try:
+            self.cache_container(self.docker_inspect(container))
+        except Exception as e:
+            self.log.debug('Unable to inspect container, flushing cache: %s' % e)
+            self.flush_containers()
+
+    # Refresh a single image record from Docker
+    def update_image(self, image):
+        try:
+            self.cache_image(self.docker_image(image))
+        except Exception as e:
+            self.log.debug('Unable to inspect image, flushing cache: %s' % e)
+            self.flush_images()
+
+    def short_id(self, id):
+        if id.startswith('sha256:'):
+            id = id[7:]
+        return id[:12]
+
+    # Resolve an image tag or a full/truncated image ID to the full image ID
+    def image_id(self, ref):
+
+        self.images()
+
+        if ref in self.image_tags:
+            return self.image_tags[ref]['Id']
+
+        if ref in self.image_ids:
+            return ref
+
+        image = self.image_short_ids.get(self.short_id(ref))
+        if image and image['Id'].replace('sha256:', '').startswith(ref.replace('sha256:', '')):
+            return image['Id']
+
+        return None
 
     def tag(self, image):
         parts = image.split(':')
@@ -40,89 +236,232 @@ class DockerClient(object):
 
     def image(self, tag=None, id=None):
 
-        for image in self.images():
-
-            if tag and not tag in image['RepoTags']:
-                continue
-
-            if id and id != image['Id']:
-                continue
+        images = self.images()
 
+        if tag:
+            image = self.image_tags.get(tag)
+            if image and id and id != image['Id']:
+                return None
             return image
 
-        return None
+        if id:
+            return self.image_ids.get(id)
+
+        return images[0] if len(images) else None
 
     def images(self):
 
-        if not len(self.image_cache):
-            try:
-                self.image_cache = self.docker_images()
-            except Exception as e:
-                self.log.error('Unable to get image list: %s' % e.message)
-                self.log.debug(traceback.format_exc())
+        with self.lock:
+            if self.image_cache is None:
+                try:
+                    self.set_images(self.docker_images())
+                except Exception as e:
+                    self.log.error('Unable to get image list: %s' % e.message)
+                    self.log.debug(traceback.format_exc())
 
-        return self.image_cache
+        return self.image_cache or []
 
-    def container(self, image=None):
+    def container(self, image=None, id=None):
 
-        for container in self.containers():
-            if image is None or image == container['Image']:
-                return container
+        containers = self.containers()
 
-        return None
+        if id:
+            container = self.container_ids.get(id)
+            if container and image and image != container['Image']:
+                return None
+            return container
+
+        if image:
+            matches = self.image_containers.get(image)
+            return matches[0] if matches else None
+
+        return containers[0] if len(containers) else None
+
+    # All containers created from an image, in listing order
+    def containers_for(self, image):
+        self.containers()
+        return list(self.image_containers.get(image, []))
+
+    # All containers carrying a label with the given value, in listing order
+    def labeled(self, key, value):
+        self.containers()
+        return list(self.label_containers.get((key, value), []))
 
     def containers(self):
 
-        if not len(self.container_cache):
+        with self.lock:
+            if self.container_cache is None:
+                try:
+                    self.set_containers(self.docker_containers(self.filters))
+                except Exception as e:
+                    self.log.error('Unable to get container list: %s' % e.message)
+                    self.log.debug(traceback.format_exc())
+
+        return self.container_cache or []
+
+    # Uncached listing of every container on the host, regardless of filters
+    def scan(self):
+        return self.docker_containers()
+
+    # Check the registry's manifest digest against the local image, so pulls can
+    # be skipped when nothing changed
+    def current(self, image):
+
+        if not self.registry:
+            return False
+
+        local = self.image(image)
+        if not local or not local.get('RepoDigests'):
+            return False
+
+        try:
+            digest = self.registry.digest(image)
+        except Exception as e:
+            self.log.debug('Unable to check registry digest for %s: %s' % (image, e))
+            return False
+
+        return digest is not None and len([d for d in local['RepoDigests'] if d.endswith('@%s' % digest)]) > 0
+
+    # Pull an image, skipping it if the registry digest matches unless `check` is
+    # False (the caller already checked)
+    def pull(self, image, check=True):
+
+        with self.tracer.span('pull', image=image):
             try:
-                self.container_cache = self.docker_containers()
+                if check and self.current(image):
+                    self.log.debug('Image is up to date: %s' % image)
+                    self.metrics.inc('dockerup_pulls_total', { 'result': 'digest_current' })
+                    return False
+                self.log.debug('Pulling image: %s', image)
+                if self.docker_pull(image):
+                    self.log.info('Updated image found: %s' % image)
+                    self.metrics.inc('dockerup_pulls_total', { 'result': 'updated' })
+                    self.update_image(image)
+                    return True
+                self.log.debug('Image is up to date')
+                self.metrics.inc('dockerup_pulls_total', { 'result': 'current' })
             except Exception as e:
-                self.log.error('Unable to get container list: %s' % e.message)
-                self.log.debug(traceback.format_exc())
+                self.log.warn('Unable to pull image: %s' % e.message)
+                self.metrics.inc('dockerup_pulls_total', { 'result': 'failed' })
+                # Missing image probably, falsy but distinguishable from "up to date"
+                return None
 
-        return self.container_cache
+            return False
 
-    def pull(self, image):
+    # Inspect a single container by ID or name, refreshing its cached record
+    def inspect(self, container, cache=True):
+        try:
+            record = self.docker_inspect(container)
+            if cache:
+                self.cache_container(record)
+            return record
+        except Exception as e:
+            self.log.debug('Unable to inspect container %s: %s' % (container, e))
+        return None
 
+    # Run a command inside a running container, returning its exit code
+    def execute(self, container, command):
         try:
-            self.log.debug('Pulling image: %s', image)
-            if self.docker_pull(image):
-                self.log.info('Updated image found: %s' % image)
-                self.flush_images()
-                return True
-            self.log.debug('Image is up to date')
+            return self.docker_exec(container, command)
         except Exception as e:
-            self.log.warn('Unable to pull image: %s' % e.message)
-            # Missing image probably, just return false
-            pass
+            self.log.debug('Unable to execute command in %s: %s' % (container, e))
+        return None
 
-        return False
+    # Stream Docker events, applying each one to the caches after the consumer
+    # has seen it (so consumers can still resolve the pre-event state)
+    def events(self):
+
+        for event in self.docker_events():
+
+            yield event
+
+            status = event.get('status')
+            id = event.get('id')
+
+            if event.get('Type', 'image' if status in self.IMAGE_EVENTS else 'container') == 'image':
+                if status == 'delete':
+                    self.uncache_image(id)
+                elif status in self.IMAGE_EVENTS:
+                    # Tag changes can't be patched from the event alone
+                    self.flush_images()
+            elif status == 'destroy':
+                self.uncache_container(id)
+            elif status in self.CONTAINER_EVENTS:
+                self.update_container(id)
 
     # Run a new container
     def run(self, entry):
 
-        container = None
+        with self.tracer.span('run', image=entry['image']):
+            container = None
+
+            self.log.info('Running container: %s' % entry['image'])
+            try:
+                container = self.docker_run(entry)
+                self.log.info('Started container: %s' % container)
+            except Exception as e:
+                self.log.error('Unable to run container: %s' % e.message)
+                self.log.debug(traceback.format_exc())
+
+            if container:
+                self.update_container(container)
+            else:
+                # May have been created but not started
+                self.flush_containers()
+
+            return container
+
+    # Create a container without starting it
+    def create(self, entry):
 
-        self.log.info('Running container: %s' % entry['image'])
+        with self.tracer.span('create', image=entry['image']):
+            container = None
+
+            self.log.info('Creating container: %s' % entry['image'])
+            try:
+                container = self.docker_create(entry)
+                self.log.info('Created container: %s' % container)
+            except Exception as e:
+                self.log.error('Unable to create container: %s' % e.message)
+                self.log.debug(traceback.format_exc())
+
+            if container:
+                self.update_container(container)
+            else:
+                self.flush_containers()
+
+            return container
+
+    # Rename container, returning whether it succeeded
+    def rename(self, container, name):
+        self.log.info('Renaming container %s to %s' % (container, name))
         try:
-            container = self.docker_run(entry)
-            self.log.info('Started container: %s' % container)
+            self.docker_rename(container, name)
         except Exception as e:
-            self.log.error('Unable to run container: %s' % e.message)
+            self.log.error('Unable to rename container: %s' % e.message)
             self.log.debug(traceback.format_exc())
-        self.flush_containers()
-
-        return container
+            return False
+        self.update_container(container)
+        return True
 
     # Start existing container
-    def start(self, container):
+    def start(self, container, entry=None):
         self.log.info('Starting container: %s', container)
         try:
-            self.docker_start(container)
+            self.docker_start(container, entry)
         except Exception as e:
             self.log.error('Unable to start container: %s' % e.message)
             self.log.debug(traceback.format_exc())
-        self.flush_containers()
+        self.update_container(container)
+
+    # Send a signal to a running container
+    def signal(self, container, sig):
+        self.log.info('Signaling container %s: %s' % (container, sig))
+        try:
+            self.docker_signal(container, sig)
+        except Exception as e:
+            self.log.error('Unable to signal container: %s' % e.message)
+            self.log.debug(traceback.format_exc())
 
     # Restart running container
     def restart(self, container):
@@ -132,19 +471,21 @@ class DockerClient(object):
         except Exception as e:
             self.log.error('Unable to restart container: %s' % e.message)
             self.log.debug(traceback.format_exc())
-        self.flush_containers()
+        self.update_container(container)
 
     # Stop running container
-    def stop(self, container, remove=True):
-        self.log.info('Stopping container: %s', container)
-        try:
-            self.docker_stop(container)
-        except Exception as e:
-            self.log.error('Unable to stop container: %s' % e.message)
-            self.log.debug(traceback.format_exc())
-        if remove:
-            self.rm(container)
-        self.flush_containers()
+    def stop(self, container, remove=True, timeout=None):
+        with self.tracer.span('stop', container=container):
+            self.log.info('Stopping container: %s', container)
+            try:
+                self.docker_stop(container, timeout)
+            except Exception as e:
+                self.log.error('Unable to stop container: %s' % e.message)
+                self.log.debug(traceback.format_exc())
+            if remove:
+                self.rm(container)
+            else:
+                self.update_container(container)
 
     # Remove container
     def rm(self, container):
@@ -154,7 +495,9 @@ class DockerClient(object):
         except Exception as e:
             self.log.error('Unable to remove container: %s' % e.message)
             self.log.debug(traceback.format_exc())
-        self.flush_containers()
+            self.flush_containers()
+            return
+        self.uncache_container(container)
 
     # Remove image
     def rmi(self, image):
@@ -164,22 +507,26 @@ class DockerClient(object):
         except Exception as e:
             self.log.error('Unable to remove image: %s' % e.message)
             self.log.debug(traceback.format_exc())
-        self.flush_images()
+            self.flush_images()
+            return
+        self.uncache_image(image)
 
-    # Cleanup stopped containers and unused images
+    # Cleanup stopped containers and, unless images=False, dangling images
     def cleanup(self, images=True):
 
         self.log.debug('Cleaning up stopped containers')
 
-        # Always refresh state before cleanup
+        # Always refresh state before cleanup; this full listing also serves as the
+        # consistency check for the write-through cache updates made during sync
         self.flush()
 
         for container in self.containers():
             if not container['Running']:
                 self.rm(container['Id'])
-        
-        for dangling in self.docker_images(filters={'dangling': 'true'}):
-            self.rmi(dangling['Id'])
+
+        if images:
+            for dangling in self.docker_images(filters={'dangling': 'true'}):
+                self.rmi(dangling['Id'])
 
     """
     Subclass implementations
@@ -190,31 +537,55 @@ class DockerClient(object):
         return []
 
     @abc.abstractmethod
-    def docker_containers(self):
+    def docker_containers(self, filters=None):
         return []
 
+    @abc.abstractmethod
+    def docker_inspect(self, container):
+        return None
+
+    @abc.abstractmethod
+    def docker_image(self, image):
+        return None
+
     @abc.abstractmethod
     def docker_pull(self, image):
         return False
 
+    @abc.abstractmethod
+    def docker_events(self):
+        return []
+
     @abc.abstractmethod
     def docker_run(self, entry):
         return None
 
+    @abc.abstractmethod
+    def docker_create(self, entry):
+        return None
+
     @abc.abstractmethod
     def docker_start(self, container, entry):
         pass
 
+    @abc.abstractmethod
+    def docker_rename(self, container, name):
+        pass
+
     @abc.abstractmethod
     def docker_signal(self, container, sig):
         pass
 
+    @abc.abstractmethod
+    def docker_exec(self, container, command):
+        return None
+
     @abc.abstractmethod
     def docker_restart(self, container):
         pass
 
     @abc.abstractmethod
-    def docker_stop(self, container):
+    def docker_stop(self, container, timeout=None):
         pass
 
     @abc.abstractmethod
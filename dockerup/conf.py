@@ -2,20 +2,53 @@ import os
 import json
 import logging
 import urllib2
+import threading
+import time
 
-def settings(args):
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def defaults():
 
-    settings = {
+    return {
         'confdir': '/etc/dockerup/containers.d',
         'remote': 'unix://var/run/docker.sock',
+        'backend': 'dockerpy',
         'interval': 60,
+        'watch_interval': 5,
         'aws': False,
+        'aws_url': UserData.URL,
+        'aws_interval': 60,
+        'events': False,
         'pull': True,
+        'pull_workers': 4,
+        'digest_check': True,
+        'pull_backoff': 30,
+        'pull_backoff_max': 3600,
+        'launch_workers': 4,
+        'stop_workers': 8,
+        'stop_timeout': 10,
+        'rolling_dir': None,
+        'logdir': '/var/log/ext',
+        'log_gc_rate': 10485760,
+        'image_gc_path': '/var/lib/docker',
+        'image_gc_free': 10,
+        'image_gc_keep': 2,
+        'metrics_port': None,
+        'metrics_file': None,
+        'trace': False,
+        'trace_keep': 10,
         'username': None,
         'password': None,
         'email': None
     }
 
+def settings(args):
+
+    settings = defaults()
+
     if os.path.exists(args.config):
         settings.update(properties(args.config))
 
@@ -31,6 +64,12 @@ def settings(args):
     if args.server is not None:
         settings['server'] = args.server
 
+    if args.events is not None:
+        settings['events'] = args.events
+
+    if args.trace is not None:
+        settings['trace'] = args.trace
+
     return settings
 
 def properties(filename):
@@ -54,26 +93,211 @@ def properties(filename):
 
 
 def files_config(directory):
+    return FilesConfig(directory).load()[0]
+
+class FilesConfig(object):
+
+    """
+    Container definitions loaded from a configuration directory. Files are only
+    reparsed when their stat fingerprint changes, and changes can be watched for
+    with inotify (if pyinotify is installed) or by polling.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.parsed = {}
+
+    def fingerprint(self):
+
+        if not os.path.exists(self.directory):
+            raise Exception('Configuration directory not found: %s' % self.directory)
+
+        fingerprint = {}
+
+        for entry in os.listdir(self.directory):
+            if entry.endswith('.json'):
+                stat = os.stat('%s/%s' % (self.directory, entry))
+                fingerprint[entry] = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+        return fingerprint
+
+    # Returns the current config and whether it changed since the last load
+    def load(self):
+
+        fingerprint = self.fingerprint()
+        changed = set(fingerprint.keys()) != set(self.parsed.keys())
+        parsed = {}
+
+        for (entry, stamp) in fingerprint.items():
+            if entry in self.parsed and self.parsed[entry][0] == stamp:
+                parsed[entry] = self.parsed[entry]
+            else:
+                logging.debug('Loading configuration from %s/%s' % (self.directory, entry))
+                with open('%s/%s' % (self.directory, entry)) as local:
+                    parsed[entry] = (stamp, json.load(local))
+                changed = True
+
+        self.parsed = parsed
+
+        return ({ 'containers': [parsed[entry][1] for entry in sorted(parsed.keys())] }, changed)
+
+    # Invoke callback from a background thread whenever the directory changes
+    def watch(self, callback, interval=5):
+
+        if pyinotify:
+            try:
+                return self.watch_inotify(callback)
+            except Exception as e:
+                logging.warn('Unable to watch %s with inotify, polling instead: %s' % (self.directory, e))
+
+        def poll():
+            last = self.fingerprint()
+            while True:
+                time.sleep(interval)
+                try:
+                    current = self.fingerprint()
+                    if current != last:
+                        last = current
+                        callback()
+                except Exception as e:
+                    logging.debug('Unable to check %s for changes: %s' % (self.directory, e))
 
-    if not os.path.exists(directory):
-        raise Exception('Configuration directory not found: %s' % directory)
+        thread = threading.Thread(target=poll, name='confdir')
+        thread.daemon = True
+        thread.start()
 
-    logging.debug('Loading configuration from %s' % directory)
+    def watch_inotify(self, callback):
 
-    containers = []
-    for entry in os.listdir(directory):
-        if entry.endswith('.json'):
-            with open('%s/%s' % (directory, entry)) as local:
-                containers.append(json.load(local))
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.name.endswith('.json'):
+                    callback()
 
-    return { 'containers': containers }
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        notifier.daemon = True
+        manager.add_watch(self.directory, pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+        notifier.start()
 
 def aws_config():
+    return UserData().load()[0]
+
+class UserData(object):
+
+    """
+    Container definitions from EC2 user-data. The last good document is cached
+    (on disk if a cache directory is given) and revalidated with conditional
+    requests, either on every load or, once watched, only from a background
+    thread so syncs never wait on the metadata service. Until a document has been
+    loaded at all, loads wait for the background thread's first fetch rather than
+    return an empty configuration. Failed fetches keep the cached configuration.
+    """
+
+    URL = 'http://instance-data.ec2.internal/latest/user-data'
+    # Not .json, which the state store would import as a legacy cache file
+    FILENAME = 'user-data.cache'
+
+    def __init__(self, cache=None, url=URL, timeout=5):
+
+        self.url = url
+        self.timeout = timeout
+        self.path = '%s/%s' % (cache, self.FILENAME) if cache else None
+        self.document = None
+        self.version = 0
+        self.loaded = 0
+        self.watching = False
+        self.attempted = threading.Event()
+        self.lock = threading.Lock()
+
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as local:
+                    self.document = json.load(local)
+                    self.version = 1
+            except Exception as e:
+                logging.warn('Ignoring unreadable user-data cache %s: %s' % (self.path, e))
+
+    # Returns the current config and whether it changed since the last load
+    def load(self):
+
+        # Once watched, only the background thread talks to the metadata service
+        if not self.watching:
+            self.fetch()
+        elif self.document is None:
+            # Nothing cached yet (first start), an empty configuration would remove
+            # every container, so wait for the first fetch
+            while not self.attempted.is_set():
+                self.attempted.wait(1)
+
+        with self.lock:
+            changed = self.version != self.loaded
+            self.loaded = self.version
+            # Callers consume the config, hand out a copy
+            config = json.loads(json.dumps(self.document['config'])) if self.document else {}
+
+        return (config, changed)
+
+    def fetch(self):
+        try:
+            return self.refresh()
+        except Exception as e:
+            logging.warn('Failed to retrieve EC2 user-data, using cached configuration: %s' % e)
+            return False
+
+    # Revalidate the cached document, returning whether it changed
+    def refresh(self):
 
-    try:
         logging.debug('Loading configuration from EC2 user-data')
-        response = urllib2.urlopen('http://instance-data.ec2.internal/latest/user-data', None, 5)
-        return json.loads(response.read())
-    except Exception as e:
-        logging.debug('Failed to retrieve EC2 user-data: %s' % e.message)
-        return {}
+
+        request = urllib2.Request(self.url)
+
+        if self.document:
+            if self.document.get('etag'):
+                request.add_header('If-None-Match', self.document['etag'])
+            if self.document.get('modified'):
+                request.add_header('If-Modified-Since', self.document['modified'])
+
+        try:
+            response = urllib2.urlopen(request, None, self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return False
+            raise
+
+        document = {
+            'config': json.loads(response.read()),
+            'etag': response.info().getheader('ETag'),
+            'modified': response.info().getheader('Last-Modified')
+        }
+
+        with self.lock:
+            changed = self.document is None or self.document['config'] != document['config']
+            self.document = document
+            if changed:
+                self.version += 1
+
+        if self.path:
+            temp = '%s.tmp' % self.path
+            with open(temp, 'w') as local:
+                json.dump(document, local)
+            os.rename(temp, self.path)
+
+        return changed
+
+    # Refresh from a background thread every interval seconds, invoking callback
+    # whenever the document changes
+    def watch(self, callback, interval=60):
+
+        self.watching = True
+
+        def poll():
+            while True:
+                if self.fetch():
+                    callback()
+                self.attempted.set()
+                time.sleep(interval)
+
+        thread = threading.Thread(target=poll, name='user-data')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,99 @@
+import os
+import time
+import fcntl
+import errno
+import logging
+import threading
+
+class UpdateCoordinator(object):
+
+    """
+    Grants update windows for rolling updates, limiting how many containers of a
+    service are replaced at the same time. This base implementation grants every
+    request immediately; subclasses coordinate through shared state.
+    """
+
+    # Wait up to `timeout` seconds for one of `limit` slots of a service, returning
+    # a token to release, or None if no slot became available
+    def acquire(self, service, limit=1, timeout=600):
+        return service
+
+    def release(self, token):
+        pass
+
+class FileCoordinator(UpdateCoordinator):
+
+    """
+    Update windows backed by lock files in a shared directory, one file per
+    service slot (<directory>/<service>.<slot>.lock). Slots are held with fcntl
+    locks, so a slot is freed automatically if its holder dies. Every dockerup
+    instance (or test) pointed at the same directory shares the same windows.
+    """
+
+    def __init__(self, directory, interval=1):
+
+        self.directory = directory
+        self.interval = float(interval)
+        self.held = {}
+        self.lock = threading.Lock()
+
+        self.log = logging.getLogger(__name__)
+
+    def acquire(self, service, limit=1, timeout=600):
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        deadline = time.time() + float(timeout)
+        name = service.replace('/', '_').replace(':', '_')
+
+        while True:
+
+            for slot in range(int(limit)):
+                token = self.take('%s/%s.%d.lock' % (self.directory, name, slot))
+                if token:
+                    self.log.debug('Acquired update window: %s' % token)
+                    return token
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+
+            time.sleep(min(self.interval, remaining))
+
+    def take(self, path):
+
+        with self.lock:
+
+            # fcntl locks are per process, so slots held by other threads of this
+            # process must be tracked separately
+            if path in self.held:
+                return None
+
+            handle = open(path, 'a')
+
+            try:
+                fcntl.lockf(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                handle.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return None
+                raise
+
+            self.held[path] = handle
+
+            return path
+
+    def release(self, token):
+
+        with self.lock:
+            handle = self.held.pop(token, None)
+
+        if handle:
+            self.log.debug('Released update window: %s' % token)
+            fcntl.lockf(handle, fcntl.LOCK_UN)
+            handle.close()
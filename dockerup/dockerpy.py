@@ -1,36 +1,79 @@
 import json
+import time
+import calendar
 
 from dockerup.client import DockerClient
-from docker.client import Client
 
 class DockerPyClient(DockerClient):
 
-    def __init__(self, remote, username=None, password=None, email=None):
-        super(DockerPyClient,self).__init__()
-        self.client = Client(base_url=remote, version='1.15')
+    def __init__(self, remote, username=None, password=None, email=None, registry=None):
+        super(DockerPyClient,self).__init__(registry)
+        self.client = self.connect(remote)
         if username:
             self.client.login(username=username, password=password, email=email)
 
+    def connect(self, remote):
+        # Imported on demand so subclasses with their own API client don't require docker-py
+        from docker.client import Client
+        return Client(base_url=remote, version='1.18')
+
     def docker_images(self, filters=None):
         return self.client.images(filters=filters)
 
-    def __id(self, ioc):
-        if ioc and 'Id' in ioc:
-            return ioc['Id']
-        return None
-        
-    def docker_containers(self):
+    def docker_containers(self, filters=None):
         return [{
             'Id': cont['Id'],
             'Tag': cont['Image'],
-            'Image': self.__id(self.image(cont['Image'])),
+            'Image': cont.get('ImageID') or self.image_id(cont['Image']),
             'Names': cont['Names'],
             'Ports': cont['Ports'],
             'Created': cont['Created'],
             'Command': cont['Command'],
             'Status': cont['Status'],
-            'Running': cont['Status'].startswith('Up ') or cont['Status'].startswith('Restarting ')
-        } for cont in self.client.containers(all=True)]
+            'Running': cont['Status'].startswith('Up ') or cont['Status'].startswith('Restarting '),
+            'Labels': cont.get('Labels') or {}
+        } for cont in self.client.containers(all=True, filters=filters)]
+
+    def docker_inspect(self, container):
+
+        cont = self.client.inspect_container(container)
+        state = cont['State']
+        running = state['Running'] or state.get('Restarting', False)
+
+        ports = []
+        for (private, bindings) in (cont['NetworkSettings']['Ports'] or {}).items():
+            (port, proto) = private.split('/')
+            for binding in bindings or [{}]:
+                mapping = { 'PrivatePort': int(port), 'Type': proto }
+                if binding.get('HostPort'):
+                    mapping['IP'] = binding['HostIp']
+                    mapping['PublicPort'] = int(binding['HostPort'])
+                ports.append(mapping)
+
+        return {
+            'Id': cont['Id'],
+            'Tag': cont['Config']['Image'],
+            'Image': cont['Image'],
+            'Names': [cont['Name']],
+            'Ports': ports,
+            'Created': calendar.timegm(time.strptime(cont['Created'][:19], '%Y-%m-%dT%H:%M:%S')),
+            'Command': ' '.join([cont['Path']] + (cont['Args'] or [])),
+            'Status': 'Up ' if running else 'Exited (%s)' % state['ExitCode'],
+            'Running': running,
+            'Labels': cont['Config'].get('Labels') or {},
+            'IPAddress': cont['NetworkSettings'].get('IPAddress')
+        }
+
+    def docker_image(self, image):
+
+        (repository, tag) = self.tag(image)
+        qualified = '%s:%s' % (repository, tag)
+
+        for img in self.client.images(name=repository):
+            if image in img['RepoTags'] or qualified in img['RepoTags']:
+                return img
+
+        return None
 
     def docker_pull(self, image):
 
@@ -43,14 +86,22 @@ class DockerPyClient(DockerClient):
                 raise Exception(parsed['error'])
 
         # Check if image updated
-        self.flush_images()
-        newer = self.image(image)
-        if not existing or (newer['Id'] != existing['Id']):
+        newer = self.docker_image(image)
+        if not existing or (newer and newer['Id'] != existing['Id']):
             return True
 
         return False
 
+    def docker_events(self):
+        for event in self.client.events():
+            yield json.loads(event) if isinstance(event, basestring) else event
+
     def docker_run(self, entry):
+        container = self.docker_create(entry)
+        self.docker_start(container, entry)
+        return container
+
+    def docker_create(self, entry):
 
         volumes = ['/var/log/ext']
 
@@ -90,11 +141,10 @@ class DockerPyClient(DockerClient):
         if 'portMappings' in entry:
             kwargs['ports'] = [p['containerPort'] for p in entry['portMappings']]
 
-        container = self.client.create_container(**kwargs)
-
-        self.docker_start(container['Id'], entry)
+        if 'labels' in entry:
+            kwargs['labels'] = entry['labels']
 
-        return container['Id']
+        return self.client.create_container(**kwargs)['Id']
 
     def docker_start(self, container, entry=None):
 
@@ -164,14 +214,25 @@ class DockerPyClient(DockerClient):
 
         self.client.start(**kwargs);
 
+    def docker_rename(self, container, name):
+        self.client.rename(container, name)
+
     def docker_signal(self, container, sig='HUP'):
         self.client.kill(container, sig)
 
+    def docker_exec(self, container, command):
+        execution = self.client.exec_create(container, command)
+        self.client.exec_start(execution['Id'])
+        return self.client.exec_inspect(execution['Id'])['ExitCode']
+
     def docker_restart(self, container):
         self.client.restart(container)
 
-    def docker_stop(self, container):
-        self.client.stop(container)
+    def docker_stop(self, container, timeout=None):
+        if timeout is None:
+            self.client.stop(container)
+        else:
+            self.client.stop(container, timeout=timeout)
 
     def docker_rm(self, container):
         self.client.remove_container(container)
@@ -0,0 +1,357 @@
+import json
+import errno
+import base64
+import shlex
+import socket
+import urllib
+import httplib
+import Queue
+
+from dockerup.dockerpy import DockerPyClient
+
+class APIError(Exception):
+
+    def __init__(self, message, status=None):
+        super(APIError, self).__init__(message)
+        self.status = status
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class EngineClient(object):
+
+    """
+    Minimal Docker Engine API client covering the subset of docker-py's Client
+    interface that dockerup uses. Requests go over pooled keep-alive connections
+    (unix socket or TCP), so concurrent workers each reuse a connection instead
+    of reconnecting for every call.
+    """
+
+    def __init__(self, base_url, version='1.18', timeout=60, pool=8):
+
+        self.version = version
+        self.timeout = timeout
+        self.pool = pool
+        self.idle = Queue.LifoQueue()
+        self.auth = None
+
+        if base_url.startswith('unix://'):
+            self.path = '/%s' % base_url[len('unix://'):].lstrip('/')
+            self.host = None
+        else:
+            self.path = None
+            self.host = base_url.split('://', 1)[-1].rstrip('/')
+
+    def connection(self, timeout):
+
+        if self.path:
+            return UnixHTTPConnection(self.path, timeout)
+
+        return httplib.HTTPConnection(self.host, timeout=timeout)
+
+    def release(self, conn, response):
+
+        if response.will_close or self.idle.qsize() >= self.pool:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    # Send a request on a pooled connection, returning the connection and response.
+    # A reused connection may have been closed by the daemon while idle; the request
+    # is retried once on a new connection only if the failure shows the daemon never
+    # received it, so a request is never sent twice.
+    def request(self, method, path, params=None, body=None, headers=None, timeout=None):
+
+        url = '/v%s%s' % (self.version, path)
+        if params:
+            url = '%s?%s' % (url, urllib.urlencode([(k, v) for (k, v) in params.items() if v is not None], True))
+
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        timeout = timeout or self.timeout
+
+        while True:
+
+            try:
+                (conn, reused) = (self.idle.get_nowait(), True)
+            except Queue.Empty:
+                (conn, reused) = (self.connection(timeout), False)
+
+            try:
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                conn.request(method, url, body, headers)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+
+            try:
+                return (conn, conn.getresponse(buffering=True))
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused and stale(e):
+                    continue
+                raise
+
+    # Perform a request and decode the complete response body
+    def call(self, method, path, params=None, body=None, headers=None, timeout=None):
+
+        (conn, response) = self.request(method, path, params, body, headers, timeout)
+
+        try:
+            data = response.read()
+        except:
+            conn.close()
+            raise
+
+        self.release(conn, response)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data)['message']
+            except Exception:
+                message = data.strip() or response.reason
+            raise APIError('%s %s: %s' % (response.status, response.reason, message), response.status)
+
+        if data and (response.getheader('Content-Type') or '').startswith('application/json'):
+            return json.loads(data)
+
+        return data
+
+    # Yield JSON documents from a streaming (chunked) response as they arrive
+    def stream(self, method, path, params=None, headers=None, timeout=None):
+
+        (conn, response) = self.request(method, path, params, None, headers, timeout)
+
+        try:
+
+            if response.status >= 400:
+                raise APIError('%s %s: %s' % (response.status, response.reason, response.read().strip()), response.status)
+
+            for document in decode(chunks(response)):
+                yield document
+
+        finally:
+            conn.close()
+
+    def filters(self, filters):
+
+        if not filters:
+            return None
+
+        converted = {}
+        for (key, value) in filters.items():
+            if isinstance(value, bool):
+                value = str(value).lower()
+            converted[key] = [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+        return json.dumps(converted)
+
+    def login(self, username, password=None, email=None, registry=None):
+
+        config = {
+            'username': username,
+            'password': password,
+            'email': email,
+            'serveraddress': registry or 'https://index.docker.io/v1/'
+        }
+
+        self.call('POST', '/auth', body=config)
+        self.auth = base64.urlsafe_b64encode(json.dumps(config))
+
+    def images(self, name=None, filters=None):
+        return self.call('GET', '/images/json', { 'filter': name, 'filters': self.filters(filters) })
+
+    def containers(self, all=False, filters=None):
+        return self.call('GET', '/containers/json', { 'all': 1 if all else 0, 'filters': self.filters(filters) })
+
+    def inspect_container(self, container):
+        return self.call('GET', '/containers/%s/json' % container)
+
+    def pull(self, repository, tag=None, stream=False, insecure_registry=False):
+
+        headers = { 'X-Registry-Auth': self.auth } if self.auth else {}
+        lines = (json.dumps(document) for document in
+            self.stream('POST', '/images/create', { 'fromImage': repository, 'tag': tag }, headers))
+
+        return lines if stream else '\n'.join(lines)
+
+    def events(self):
+        # Blocks until the daemon sends the next event
+        return self.stream('GET', '/events', timeout=365 * 24 * 3600)
+
+    def create_container(self, image, command=None, detach=False, environment=None, volumes=None,
+            ports=None, name=None, cpu_shares=None, mem_limit=None, entrypoint=None, labels=None,
+            volumes_from=None):
+
+        # Host configuration (binds, port bindings, volumes-from) is applied on start
+        config = {
+            'Image': image,
+            'Cmd': shlex.split(command) if isinstance(command, basestring) else command,
+            'Entrypoint': shlex.split(entrypoint) if isinstance(entrypoint, basestring) else entrypoint,
+            'Env': ['%s=%s' % (k, v) for (k, v) in (environment or {}).items()],
+            'Volumes': dict([(v, {}) for v in volumes or []]),
+            'ExposedPorts': dict([(port_spec(p), {}) for p in ports or []]),
+            'CpuShares': cpu_shares or 0,
+            'Memory': memory(mem_limit) if mem_limit else 0,
+            'Labels': labels or {},
+            'AttachStdin': False,
+            'AttachStdout': not detach,
+            'AttachStderr': not detach
+        }
+
+        return self.call('POST', '/containers/create', { 'name': name }, config)
+
+    def start(self, container, binds=None, port_bindings=None, links=None, volumes_from=None,
+            network_mode=None, restart_policy=None, privileged=False):
+
+        config = {
+            'Binds': ['%s:%s:%s' % (host, bind['bind'], 'ro' if bind['ro'] else 'rw') for (host, bind) in (binds or {}).items()],
+            'PortBindings': dict([(port_spec(port), [{ 'HostIp': '', 'HostPort': str(host) if host else '' }])
+                for (port, host) in (port_bindings or {}).items()]),
+            'Links': ['%s:%s' % (name, alias) for (name, alias) in (links or {}).items()],
+            'VolumesFrom': volumes_from or [],
+            'Privileged': privileged
+        }
+
+        if network_mode:
+            config['NetworkMode'] = network_mode
+
+        if restart_policy:
+            config['RestartPolicy'] = restart_policy
+
+        self.call('POST', '/containers/%s/start' % container, body=config)
+
+    def rename(self, container, name):
+        self.call('POST', '/containers/%s/rename' % container, { 'name': name })
+
+    def kill(self, container, signal=None):
+        self.call('POST', '/containers/%s/kill' % container, { 'signal': signal })
+
+    def exec_create(self, container, cmd):
+        return self.call('POST', '/containers/%s/exec' % container, body={
+            'AttachStdin': False,
+            'AttachStdout': True,
+            'AttachStderr': True,
+            'Tty': False,
+            'Cmd': shlex.split(cmd) if isinstance(cmd, basestring) else cmd
+        })
+
+    def exec_start(self, exec_id):
+        return self.call('POST', '/exec/%s/start' % exec_id, body={ 'Detach': False, 'Tty': False })
+
+    def exec_inspect(self, exec_id):
+        return self.call('GET', '/exec/%s/json' % exec_id)
+
+    def restart(self, container, timeout=10):
+        self.call('POST', '/containers/%s/restart' % container, { 't': timeout }, timeout=self.timeout + timeout)
+
+    def stop(self, container, timeout=10):
+        self.call('POST', '/containers/%s/stop' % container, { 't': timeout }, timeout=self.timeout + timeout)
+
+    def remove_container(self, container):
+        self.call('DELETE', '/containers/%s' % container)
+
+    def remove_image(self, image, force=False):
+        self.call('DELETE', '/images/%s' % image, { 'force': 1 if force else 0 })
+
+class SocketClient(DockerPyClient):
+
+    """
+    Docker backend using dockerup's own pooled Engine API client instead of
+    docker-py. Selected with backend=socket.
+    """
+
+    def __init__(self, remote, username=None, password=None, email=None, registry=None, pool=8):
+        self.pool = pool
+        super(SocketClient, self).__init__(remote, username, password, email, registry)
+
+    def connect(self, remote):
+        return EngineClient(remote, pool=self.pool)
+
+# Whether a failure reading the response means the connection was closed before
+# the request was read: closed without a status line, or reset. Malformed responses
+# and timeouts are not retried, the daemon may have acted on the request.
+def stale(error):
+
+    if isinstance(error, httplib.BadStatusLine):
+        # Older Python 2.7 releases report an empty status line as "''"
+        return error.line in ('', "''") or error.line.startswith('No status line')
+
+    if isinstance(error, socket.timeout):
+        return False
+
+    return isinstance(error, socket.error) and error.errno in (errno.ECONNRESET, errno.EPIPE)
+
+# Port specification as used by the API, e.g. 8080 -> '8080/tcp'
+def port_spec(port):
+    port = str(port)
+    return port if '/' in port else '%s/tcp' % port
+
+# Memory limit in bytes from values like 512m or 2g
+def memory(value):
+
+    if isinstance(value, (int, long)):
+        return value
+
+    units = { 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+    value = str(value).strip().lower()
+
+    if value[-1:] in units:
+        return int(value[:-1]) * units[value[-1]]
+
+    return int(value)
+
+# Raw body chunks of a response as they arrive, decoding chunked transfer encoding
+def chunks(response):
+
+    if not response.chunked:
+        data = response.read()
+        if data:
+            yield data
+        return
+
+    while True:
+        line = response.fp.readline()
+        if not line:
+            return
+        size = int(line.split(';', 1)[0].strip(), 16)
+        if size == 0:
+            return
+        yield response.fp.read(size)
+        response.fp.read(2)
+
+# Split concatenated JSON documents, which may be split or combined across chunks
+def decode(chunks):
+
+    decoder = json.JSONDecoder()
+    buffered = ''
+
+    for chunk in chunks:
+
+        buffered += chunk
+
+        while True:
+            buffered = buffered.lstrip()
+            if not buffered:
+                break
+            try:
+                (document, end) = decoder.raw_decode(buffered)
+            except ValueError:
+                break
+            buffered = buffered[end:]
+            yield document
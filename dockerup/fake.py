@@ -0,0 +1,288 @@
+import time
+import random
+import hashlib
+import threading
+import Queue
+
+from dockerup.client import DockerClient
+
+class FakeDockerClient(DockerClient):
+
+    """
+    In-memory Docker backend for benchmarks and experiments. Every backend call
+    sleeps for `latency` seconds (overridable per call via `latencies`) and fails
+    with probability `failure_rate`. Registry contents are simulated with
+    publish(); pulls copy the published image into the local image store.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, latencies=None, seed=None):
+
+        super(FakeDockerClient, self).__init__()
+
+        self.latency = float(latency)
+        self.latencies = latencies or {}
+        self.failure_rate = float(failure_rate)
+        self.random = random.Random(seed)
+
+        self.local = {}
+        self.remote = {}
+        self.running = {}
+        self.sequence = 0
+        self.queue = Queue.Queue()
+        self.store_lock = threading.RLock()
+
+    def simulate(self, call):
+
+        delay = self.latencies.get(call, self.latency)
+        if delay:
+            time.sleep(delay)
+
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise Exception('Injected failure in %s' % call)
+
+    def generate_id(self, *parts):
+        with self.store_lock:
+            self.sequence += 1
+            return hashlib.sha256('%s:%s' % (self.sequence, ':'.join(parts))).hexdigest()
+
+    def qualify(self, image):
+        return image if ':' in image.rsplit('/', 1)[-1] else '%s:latest' % image
+
+    # Publish a new image version to the simulated registry
+    def publish(self, tag):
+        tag = self.qualify(tag)
+        self.remote[tag] = self.generate_id(tag)
+        return self.remote[tag]
+
+    # Add an image to the local image store, moving the tag if already present
+    def add_image(self, tag, id=None):
+
+        with self.store_lock:
+
+            tag = self.qualify(tag)
+            id = id or self.generate_id(tag)
+
+            for image in self.local.values():
+                if tag in image['RepoTags']:
+                    image['RepoTags'].remove(tag)
+                    if not len(image['RepoTags']):
+                        image['RepoTags'].append('<none>:<none>')
+
+            image = self.local.setdefault(id, {
+                'Id': id,
+                'RepoTags': [],
+                'RepoDigests': [],
+                'Created': int(time.time()),
+                'Size': 0,
+                'VirtualSize': 0
+            })
+            image['RepoTags'] = [t for t in image['RepoTags'] if t != '<none>:<none>'] + [tag]
+
+            return id
+
+    def emit(self, status, id, **extra):
+        event = { 'status': status, 'id': id, 'time': int(time.time()) }
+        event.update(extra)
+        self.queue.put(event)
+
+    def lookup(self, container):
+
+        if container in self.running:
+            return self.running[container]
+
+        for record in self.running.values():
+            if '/%s' % container in record['Names']:
+                return record
+
+        raise Exception('No such container: %s' % container)
+
+    def docker_images(self, filters=None):
+
+        self.simulate('docker_images')
+
+        with self.store_lock:
+            images = [dict(image, RepoTags=list(image['RepoTags'])) for image in self.local.values()]
+
+        if filters and filters.get('dangling') in ('true', True):
+            images = [image for image in images if image['RepoTags'] == ['<none>:<none>']]
+
+        return images
+
+    # Supports the label and status filters
+    def matches(self, record, filters):
+
+        for label in (filters or {}).get('label', []):
+            (key, value) = label.split('=', 1) if '=' in label else (label, None)
+            if not key in record['Labels'] or (value is not None and record['Labels'][key] != value):
+                return False
+
+        if 'status' in (filters or {}):
+            status = 'running' if record['Running'] else 'created' if record['Status'] == 'Created' else 'exited'
+            if not status in filters['status']:
+                return False
+
+        return True
+
+    def docker_containers(self, filters=None):
+
+        self.simulate('docker_containers')
+
+        with self.store_lock:
+            return [dict(record) for record in sorted(self.running.values(), key=lambda r: -r['Created'])
+                if self.matches(record, filters)]
+
+    def docker_inspect(self, container):
+        self.simulate('docker_inspect')
+        with self.store_lock:
+            return dict(self.lookup(container))
+
+    def docker_image(self, image):
+
+        self.simulate('docker_image')
+
+        tag = self.qualify(image)
+
+        with self.store_lock:
+            for record in self.local.values():
+                if tag in record['RepoTags']:
+                    return dict(record, RepoTags=list(record['RepoTags']))
+
+        return None
+
+    def docker_pull(self, image):
+
+        self.simulate('docker_pull')
+
+        tag = self.qualify(image)
+
+        if not tag in self.remote:
+            raise Exception('Image not found: %s' % image)
+
+        with self.store_lock:
+            if self.remote[tag] in self.local and tag in self.local[self.remote[tag]]['RepoTags']:
+                return False
+            self.add_image(tag, self.remote[tag])
+            # Pulled images keep their repo digest when the tag moves on
+            self.local[self.remote[tag]]['RepoDigests'].append('%s@sha256:%s' % (tag.rsplit(':', 1)[0], self.remote[tag]))
+
+        self.emit('pull', tag)
+
+        return True
+
+    def docker_events(self):
+        while True:
+            yield self.queue.get()
+
+    def docker_run(self, entry):
+        self.simulate('docker_run')
+        id = self.docker_create(entry)
+        self.docker_start(id, entry)
+        return id
+
+    def docker_create(self, entry):
+
+        self.simulate('docker_create')
+
+        tag = self.qualify(entry['image'])
+
+        with self.store_lock:
+
+            image = [record for record in self.local.values() if tag in record['RepoTags']]
+            if not len(image):
+                raise Exception('No such image: %s' % entry['image'])
+
+            id = self.generate_id(tag)
+            name = entry.get('name', id[:12])
+
+            for record in self.running.values():
+                if '/%s' % name in record['Names']:
+                    raise Exception('Conflict, name already in use: %s' % name)
+
+            self.running[id] = {
+                'Id': id,
+                'Tag': entry['image'],
+                'Image': image[0]['Id'],
+                'Names': ['/%s' % name],
+                'Ports': [],
+                'Created': time.time(),
+                'Command': entry.get('command', ''),
+                'Status': 'Created',
+                'Running': False,
+                'Labels': dict(entry.get('labels', {})),
+                'IPAddress': '127.0.0.1'
+            }
+
+        self.emit('create', id, **{ 'from': entry['image'] })
+
+        return id
+
+    def docker_start(self, container, entry=None):
+
+        self.simulate('docker_start')
+
+        with self.store_lock:
+            record = self.lookup(container)
+            record['Running'] = True
+            record['Status'] = 'Up 1 seconds'
+
+        self.emit('start', record['Id'])
+
+    def docker_rename(self, container, name):
+
+        self.simulate('docker_rename')
+
+        with self.store_lock:
+            record = self.lookup(container)
+            for other in self.running.values():
+                if other is not record and '/%s' % name in other['Names']:
+                    raise Exception('Conflict, name already in use: %s' % name)
+            record['Names'] = ['/%s' % name]
+
+        self.emit('rename', record['Id'])
+
+    def docker_signal(self, container, sig='HUP'):
+        self.simulate('docker_signal')
+        with self.store_lock:
+            self.lookup(container)
+
+    def docker_exec(self, container, command):
+        self.simulate('docker_exec')
+        return 0
+
+    def docker_restart(self, container):
+        self.docker_stop(container)
+        self.docker_start(container)
+
+    def docker_stop(self, container, timeout=None):
+
+        self.simulate('docker_stop')
+
+        with self.store_lock:
+            record = self.lookup(container)
+            record['Running'] = False
+            record['Status'] = 'Exited (0) 1 seconds ago'
+
+        self.emit('die', record['Id'])
+
+    def docker_rm(self, container):
+
+        self.simulate('docker_rm')
+
+        with self.store_lock:
+            record = self.lookup(container)
+            if record['Running']:
+                raise Exception('Conflict, container is running: %s' % container)
+            del self.running[record['Id']]
+
+        self.emit('destroy', record['Id'])
+
+    def docker_rmi(self, image):
+
+        self.simulate('docker_rmi')
+
+        with self.store_lock:
+            if not image in self.local:
+                raise Exception('No such image: %s' % image)
+            del self.local[image]
+
+        self.emit('delete', image)
@@ -0,0 +1,101 @@
+import os
+import time
+import logging
+
+class ImageCollector(object):
+
+    """
+    Disk-pressure-aware image garbage collection. The last time each image was
+    used by a running container is tracked in the state store. When free space
+    on the Docker data volume drops below the watermark, images no container
+    references are removed least recently used first, always keeping the newest
+    `keep` images of each repository for fast rollback. Previous versions of a
+    moving tag (e.g. latest) are untagged, so they count towards their repository
+    through their repo digests; while collection is enabled, such dangling images
+    are only removed under disk pressure.
+    """
+
+    SECTION = 'images'
+
+    def __init__(self, docker, state, path='/var/lib/docker', watermark=10, keep=2):
+
+        self.docker = docker
+        self.state = state
+        self.path = path
+        self.watermark = float(watermark)
+        self.keep = int(keep)
+
+        self.log = logging.getLogger(__name__)
+
+    # Record images as used now
+    def touch(self, images):
+
+        now = time.time()
+
+        for image in images:
+            # Refreshed timestamps alone don't justify a state write
+            self.state.put(image, now, self.SECTION, self.state.get(image, self.SECTION) is None)
+
+    # Whether collection (and with it removal of dangling images) is up to this collector
+    def enabled(self):
+        return self.watermark > 0 and os.path.exists(self.path)
+
+    # Percentage of free space on the Docker data volume
+    def free(self):
+        stat = os.statvfs(self.path)
+        return 100.0 * stat.f_bavail / stat.f_blocks if stat.f_blocks else 100.0
+
+    # Images kept regardless of use: the newest per repository
+    def retained(self, images):
+
+        repositories = {}
+
+        for image in images:
+            for tag in image['RepoTags'] or []:
+                if not tag.startswith('<none>'):
+                    repositories.setdefault(tag.rsplit(':', 1)[0], {})[image['Id']] = image
+            # Survive the tag moving to a newer image
+            for digest in image.get('RepoDigests') or []:
+                if not digest.startswith('<none>'):
+                    repositories.setdefault(digest.split('@', 1)[0], {})[image['Id']] = image
+
+        retained = set()
+
+        for repository in repositories.values():
+            newest = sorted(repository.values(), key=lambda i: i['Created'], reverse=True)
+            retained.update([i['Id'] for i in newest[:self.keep]])
+
+        return retained
+
+    def collect(self):
+
+        if not self.enabled():
+            return
+
+        free = self.free()
+        if free >= self.watermark:
+            return
+
+        self.log.info('Free space at %.1f%% (watermark %.1f%%), removing unused images' % (free, self.watermark))
+
+        images = list(self.docker.images())
+        # Every container on the host, including those dockerup doesn't manage
+        referenced = set([c['Image'] for c in self.docker.scan()])
+        retained = self.retained(images)
+
+        candidates = [i for i in images if not i['Id'] in referenced and not i['Id'] in retained]
+        candidates.sort(key=lambda i: self.state.get(i['Id'], self.SECTION) or i['Created'])
+
+        for image in candidates:
+
+            if self.free() >= self.watermark:
+                break
+
+            self.docker.rmi(image['Id'])
+            self.state.delete(image['Id'], self.SECTION)
+
+        # Forget images that no longer exist
+        existing = set([i['Id'] for i in self.docker.images()])
+        for (image, used) in self.state.items(self.SECTION):
+            if not image in existing:
+                self.state.delete(image, self.SECTION)
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import threading
+
+class LogCollector(object):
+
+    """
+    Removes per-container log directories left behind by containers that are no
+    longer running. Collection runs on a background thread and deletes at a
+    bounded rate, so a large backlog doesn't stall syncs or compete with running
+    containers for disk I/O.
+    """
+
+    def __init__(self, directory='/var/log/ext', rate=10485760):
+
+        self.directory = directory
+        self.rate = float(rate)
+
+        self.pending = None
+        self.busy = False
+        self.freed = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+        self.log = logging.getLogger(__name__)
+
+    # Queue a collection pass; only the most recent running set is kept
+    def collect(self, running):
+
+        with self.condition:
+            self.pending = (set(running), time.time())
+            self.condition.notify_all()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='logs')
+                self.thread.daemon = True
+                self.thread.start()
+
+    # Block until queued collection has finished
+    def drain(self):
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait(1)
+
+    def run(self):
+
+        while True:
+
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                (running, since) = self.pending
+                self.pending = None
+                self.busy = True
+
+            try:
+                self.gc(running, since)
+            except Exception as e:
+                self.log.error('Log cleanup failed: %s' % e)
+
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def gc(self, running, since):
+
+        if not os.path.exists(self.directory):
+            return
+
+        removed = 0
+        freed = 0
+
+        for entry in os.listdir(self.directory):
+
+            path = '%s/%s' % (self.directory, entry)
+
+            # Skip directories touched after the running set was taken, they may
+            # belong to containers launched since
+            if entry in running or not os.path.isdir(path) or os.path.getmtime(path) >= since:
+                continue
+
+            self.log.info('Removing old logs for %s' % entry)
+            freed += self.remove(path)
+            removed += 1
+
+        if removed:
+            self.freed += freed
+            self.log.info('Removed %s old log directories, %s bytes freed' % (removed, freed))
+
+    # Delete a directory tree, throttled to the configured byte rate
+    def remove(self, path):
+
+        freed = 0
+        started = time.time()
+
+        for (root, dirs, files) in os.walk(path, topdown=False):
+
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    freed += os.lstat(filename).st_size
+                    os.remove(filename)
+                except OSError as e:
+                    self.log.debug('Unable to remove %s: %s' % (filename, e))
+
+                if self.rate > 0:
+                    ahead = freed / self.rate - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+            for name in dirs:
+                dirname = os.path.join(root, name)
+                if os.path.islink(dirname):
+                    os.remove(dirname)
+                else:
+                    os.rmdir(dirname)
+
+        os.rmdir(path)
+
+        return freed
@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+import logging
+import BaseHTTPServer
+from contextlib import contextmanager
+
+class Metrics(object):
+
+    """
+    Thread-safe counters, gauges and summaries, rendered in the Prometheus text
+    exposition format. Served over HTTP in server mode, or written to a textfile
+    (for node_exporter's textfile collector) after one-shot runs.
+    """
+
+    def __init__(self):
+
+        self.values = {}
+        self.types = {}
+        self.lock = threading.Lock()
+
+        self.log = logging.getLogger(__name__)
+
+    def key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            self.types[name] = 'counter'
+            key = self.key(name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.types[name] = 'gauge'
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        with self.lock:
+            self.types[name] = 'summary'
+            for (suffix, amount) in (('_count', 1), ('_sum', value)):
+                key = self.key(name + suffix, labels)
+                self.values[key] = self.values.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, labels)
+
+    def render(self):
+
+        with self.lock:
+            values = sorted(self.values.items())
+            types = dict(self.types)
+
+        lines = []
+        declared = set()
+
+        for ((name, labels), value) in values:
+
+            family = name
+            if not family in types:
+                family = name.rsplit('_', 1)[0]
+
+            if not family in declared:
+                lines.append('# TYPE %s %s' % (family, types[family]))
+                declared.add(family)
+
+            if len(labels):
+                name = '%s{%s}' % (name, ','.join(['%s="%s"' % (k, self.escape(v)) for (k, v) in labels]))
+
+            lines.append('%s %s' % (name, repr(float(value))))
+
+        return '\n'.join(lines) + '\n'
+
+    # Atomically write metrics to a textfile
+    def write(self, filename):
+
+        temp = '%s.tmp' % filename
+
+        with open(temp, 'w') as local:
+            local.write(self.render())
+
+        os.rename(temp, filename)
+
+    # Serve metrics over HTTP from a background thread
+    def serve(self, port, address=''):
+
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics.log.debug(format % args)
+
+        server = BaseHTTPServer.HTTPServer((address, int(port)), Handler)
+
+        thread = threading.Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+
+        return server
@@ -0,0 +1,104 @@
+class Action(object):
+
+    """
+    A single step of a reconciliation plan. Actions with `conditions` only run if
+    a pull of at least one of the listed images actually updated it; otherwise
+    the action always runs.
+    """
+
+    def __init__(self, kind, entry=None, status=None, target=None, reason=None, conditions=(), level=0):
+        self.kind = kind
+        self.entry = entry
+        self.status = status
+        self.target = target
+        self.reason = reason
+        self.conditions = list(conditions)
+        self.level = level
+
+    def describe(self):
+
+        if self.kind == 'pull':
+            return self.target
+
+        if self.kind == 'signal':
+            return '%s %s' % (self.target, self.entry['signal'][self.target])
+
+        if self.entry:
+            if 'name' in self.entry:
+                return '%s (%s)' % (self.entry['name'], self.entry['image'])
+            return self.entry['image']
+
+        return self.status['Id'][:12]
+
+    def __str__(self):
+
+        line = '%-8s %s' % (self.kind, self.describe())
+
+        if self.reason:
+            line = '%s: %s' % (line, self.reason)
+
+        if self.conditions:
+            line = '%s, if %s updated' % (line, ' or '.join(self.conditions))
+
+        return line
+
+class Plan(object):
+
+    """
+    Actions needed to bring Docker in line with the configuration, computed from
+    a single snapshot of Docker state. Besides the actions themselves, a plan
+    records the state store changes to apply and the pre-pull image of every
+    image it pulls, so containers of updated images are replaced rather than
+    duplicated.
+    """
+
+    def __init__(self):
+        self.actions = []
+        self.remember = []
+        self.forget = []
+        self.previous = {}
+        self.intervals = {}
+        self.deferred = []
+        self.current = []
+        self.results = {}
+        self.scanned = []
+
+    def add(self, action):
+        self.actions.append(action)
+        return action
+
+    def of(self, *kinds):
+        return [action for action in self.actions if action.kind in kinds]
+
+    # Launch actions grouped by dependency level, in execution order
+    def levels(self):
+
+        levels = []
+
+        for action in self.of('create', 'start', 'replace'):
+            while len(levels) <= action.level:
+                levels.append([])
+            levels[action.level].append(action)
+
+        return [level for level in levels if len(level)]
+
+    # Signal actions to send once a launch action has completed
+    def signals(self, launch):
+        return [action for action in self.of('signal') if action.entry is launch.entry]
+
+    # Whether an action should run given the pull results so far
+    def applies(self, action):
+        return not action.conditions or any(self.results.get(image) for image in action.conditions)
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __str__(self):
+
+        if not len(self.actions):
+            return 'Nothing to do'
+
+        # In execution order
+        ordered = self.of('stop', 'remove') + self.of('pull') + self.of('create', 'start', 'replace', 'signal')
+
+        return '\n'.join([str(action) for action in ordered])
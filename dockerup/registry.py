@@ -0,0 +1,144 @@
+import re
+import json
+import time
+import base64
+import logging
+import urllib
+import urllib2
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+class Registry(object):
+
+    """
+    Minimal Docker registry (v2 API) client, used to look up the manifest digest
+    a tag currently points to without pulling it. Like dockerup's pulls, non-default
+    registries fall back to plain HTTP when HTTPS is unavailable. Credentials are
+    only sent for the registry they were configured for (Docker Hub, like dockerup's
+    login), and never over plain HTTP.
+    """
+
+    DEFAULT = 'registry-1.docker.io'
+
+    ACCEPT = ', '.join([
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.oci.image.index.v1+json',
+        'application/vnd.oci.image.manifest.v1+json'
+    ])
+
+    def __init__(self, username=None, password=None, timeout=5, registry=DEFAULT):
+
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.registry = registry
+
+        self.schemes = {}
+        self.tokens = {}
+
+        self.log = logging.getLogger(__name__)
+
+    # Split an image reference into (registry, repository, tag)
+    def parse(self, image):
+
+        registry = self.DEFAULT
+        parts = image.split('/', 1)
+
+        if len(parts) > 1 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+            (registry, image) = parts
+
+        tag = 'latest'
+        if ':' in image:
+            (image, tag) = image.rsplit(':', 1)
+
+        if registry == self.DEFAULT and not '/' in image:
+            image = 'library/%s' % image
+
+        return (registry, image, tag)
+
+    # Return the manifest digest for an image tag, or None if it can't be determined
+    def digest(self, image):
+
+        if '@' in image:
+            # Already pinned to a digest
+            return image.split('@', 1)[1]
+
+        (registry, repository, tag) = self.parse(image)
+        response = self.request(registry, '/v2/%s/manifests/%s' % (repository, tag), repository)
+
+        return response.info().getheader('Docker-Content-Digest')
+
+    def request(self, registry, path, repository):
+
+        schemes = [self.schemes[registry]] if registry in self.schemes else ['https', 'http']
+        if registry == self.DEFAULT:
+            schemes = ['https']
+
+        error = None
+
+        for scheme in schemes:
+            url = '%s://%s%s' % (scheme, registry, path)
+            try:
+                response = self.open(url, registry, repository)
+                self.schemes[registry] = scheme
+                return response
+            except urllib2.HTTPError:
+                raise
+            except Exception as e:
+                # Connection/TLS failure, try the next scheme
+                error = e
+
+        raise error
+
+    def open(self, url, registry, repository, retry=True):
+
+        request = HeadRequest(url, headers={ 'Accept': self.ACCEPT })
+
+        auth = self.tokens.get((registry, repository))
+        if auth and auth[1] > time.time():
+            request.add_header('Authorization', auth[0])
+
+        try:
+            return urllib2.urlopen(request, None, self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code != 401 or not retry:
+                raise
+            self.authenticate(registry, repository, e.info().getheader('WWW-Authenticate') or '', url.startswith('https:'))
+            return self.open(url, registry, repository, False)
+
+    # Obtain credentials in response to a 401 challenge from a registry reached over
+    # HTTPS (secure) or plain HTTP
+    def authenticate(self, registry, repository, challenge, secure=True):
+
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        basic = None
+
+        if self.username and registry == self.registry:
+            basic = 'Basic %s' % base64.b64encode('%s:%s' % (self.username, self.password))
+
+        if challenge.lower().startswith('basic'):
+            if not basic or not secure:
+                raise Exception('Registry %s requires credentials' % registry)
+            self.tokens[(registry, repository)] = (basic, time.time() + 3600)
+            return
+
+        if not 'realm' in params:
+            raise Exception('Unsupported registry challenge: %s' % challenge)
+
+        query = dict([(k, params[k]) for k in ('service', 'scope') if k in params])
+        if not 'scope' in query:
+            query['scope'] = 'repository:%s:pull' % repository
+
+        request = urllib2.Request('%s?%s' % (params['realm'], urllib.urlencode(query)))
+        if basic and params['realm'].lower().startswith('https:'):
+            request.add_header('Authorization', basic)
+
+        token = json.loads(urllib2.urlopen(request, None, self.timeout).read())
+        value = token.get('token') or token.get('access_token')
+        expires = int(token.get('expires_in', 60))
+
+        # Renew slightly early to avoid racing the expiry
+        self.tokens[(registry, repository)] = ('Bearer %s' % value, time.time() + max(expires - 10, 0))
@@ -0,0 +1,49 @@
+import time
+import random
+
+class PullScheduler(object):
+
+    """
+    Decides when each image is next due for a pull. The last pull time, result
+    and consecutive failure count are kept in the state store. Failed pulls
+    (including missing images) back off exponentially, and every delay is
+    jittered so hosts sharing a registry don't poll in lockstep.
+    """
+
+    SECTION = 'pulls'
+
+    def __init__(self, state, backoff=30, max_backoff=3600, jitter=0.1):
+        self.state = state
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.jitter = float(jitter)
+
+    def due(self, image):
+        record = self.state.get(image, self.SECTION)
+        return record is None or time.time() >= record['next']
+
+    # Record a pull result: True (updated), False (current) or None (failed)
+    def record(self, image, result, interval=0):
+
+        now = time.time()
+        previous = self.state.get(image, self.SECTION)
+        failures = 0
+
+        if result is None:
+            failures = (previous['failures'] if previous else 0) + 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        else:
+            delay = float(interval)
+
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        record = {
+            'last': now,
+            'next': now + delay,
+            'result': result,
+            'failures': failures
+        }
+
+        # Only force a state write when the outcome changed, not just timestamps
+        changed = not previous or previous['failures'] != failures or previous['result'] != result
+        self.state.put(image, record, self.SECTION, changed)
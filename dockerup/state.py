@@ -0,0 +1,115 @@
+import os
+import json
+import logging
+import threading
+
+class StateStore(object):
+
+    """
+    Persistent dockerup state (cached container configurations, keyed by cache
+    name). Loaded once at startup and kept in memory; changes are written back as
+    a single file that is replaced atomically, and only when something changed.
+
+    Per-entry cache files from older versions are imported on first load and
+    removed once the state file has been written.
+    """
+
+    FILENAME = 'dockerup.state'
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.path = '%s/%s' % (directory, self.FILENAME)
+        self.data = { 'entries': {} }
+        self.legacy = []
+        self.dirty = False
+        self.lock = threading.RLock()
+
+        self.log = logging.getLogger(__name__)
+
+        self.load()
+
+    def load(self):
+
+        if os.path.exists(self.path):
+            with open(self.path) as local:
+                self.data.update(json.load(local))
+            return
+
+        # Import per-entry cache files written by older versions
+        for cached in os.listdir(self.directory):
+            if cached.endswith('.json'):
+                cachefile = '%s/%s' % (self.directory, cached)
+                try:
+                    with open(cachefile) as local:
+                        entry = json.load(local)
+                except Exception as e:
+                    self.log.warn('Skipping unreadable cache file %s: %s' % (cachefile, e))
+                    continue
+                # Only files named after the entry they contain are cache files
+                if not isinstance(entry, dict) or not 'image' in entry or self.legacy_name(entry) != cached[:-5]:
+                    self.log.debug('Skipping unrecognized file in cache directory: %s' % cachefile)
+                    continue
+                self.data['entries'][cached[:-5]] = entry
+                self.legacy.append(cachefile)
+
+        if len(self.legacy):
+            self.log.info('Imported %s cached configurations' % len(self.legacy))
+            self.dirty = True
+
+    # Cache file name used by older versions for an entry
+    def legacy_name(self, entry):
+
+        image_clean = entry['image'].replace(':', '_').replace('/', '_')
+
+        if 'name' in entry:
+            return '%s-%s' % (image_clean, entry['name'])
+
+        return image_clean
+
+    def get(self, name, section='entries'):
+        return self.data.get(section, {}).get(name)
+
+    # Store a value; dirty=False keeps it in memory until the next real change
+    # is saved, for data that is cheap to lose (e.g. timestamps)
+    def put(self, name, value, section='entries', dirty=True):
+        with self.lock:
+            self.data.setdefault(section, {})[name] = value
+            self.dirty = self.dirty or dirty
+
+    def delete(self, name, section='entries'):
+        with self.lock:
+            if name in self.data.get(section, {}):
+                del self.data[section][name]
+                self.dirty = True
+
+    def items(self, section='entries'):
+        with self.lock:
+            return self.data.get(section, {}).items()
+
+    def values(self, section='entries'):
+        return [value for (name, value) in self.items(section)]
+
+    # Write state to disk if it changed since the last save
+    def save(self):
+
+        with self.lock:
+
+            if not self.dirty:
+                return False
+
+            temp = '%s.tmp' % self.path
+
+            with open(temp, 'w') as local:
+                json.dump(self.data, local)
+                local.flush()
+                os.fsync(local.fileno())
+
+            os.rename(temp, self.path)
+            self.dirty = False
+
+            for cachefile in self.legacy:
+                os.unlink(cachefile)
+            self.legacy = []
+
+            return True
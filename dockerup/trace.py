@@ -0,0 +1,86 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Tracer(object):
+
+    """
+    Records nested spans as Chrome trace events (load the files in
+    chrome://tracing or Perfetto). Spans collected since the last flush are
+    written to one file per sync in the trace directory, keeping only the newest
+    `keep` files. A tracer without a directory is disabled and hands out a shared
+    no-op span, so instrumented code pays almost nothing when tracing is off.
+    """
+
+    def __init__(self, directory=None, keep=10):
+
+        self.directory = directory
+        self.keep = int(keep)
+        self.events = []
+        self.lock = threading.Lock()
+
+    def span(self, name, **args):
+
+        if not self.directory:
+            return NULL_SPAN
+
+        return self.record(name, args)
+
+    @contextmanager
+    def record(self, name, args):
+
+        started = time.time()
+
+        try:
+            yield
+        finally:
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': int(started * 1000000),
+                'dur': int((time.time() - started) * 1000000),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args
+            }
+            with self.lock:
+                self.events.append(event)
+
+    # Write collected spans to a new trace file and rotate old ones
+    def flush(self):
+
+        if not self.directory:
+            return None
+
+        with self.lock:
+            events = self.events
+            self.events = []
+
+        if not len(events):
+            return None
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        filename = '%s/trace-%d.json' % (self.directory, int(time.time() * 1000))
+
+        with open(filename, 'w') as local:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, local)
+
+        traces = sorted([t for t in os.listdir(self.directory) if t.startswith('trace-') and t.endswith('.json')])
+        for old in traces[:-self.keep]:
+            os.unlink('%s/%s' % (self.directory, old))
+
+        return filename
@@ -0,0 +1,18 @@
+from multiprocessing.pool import ThreadPool
+
+# Apply fn to every item using up to `workers` threads, returning results in
+# item order. Runs inline when there is nothing to parallelize.
+def pmap(fn, items, workers=1):
+
+    items = list(items)
+    workers = min(int(workers), len(items))
+
+    if workers <= 1:
+        return [fn(item) for item in items]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
@@ -17,4 +17,4 @@ setup(name='dockerup',
 		('/etc/dockerup', ['etc/dockerup.conf']),
 		('/etc/dockerup/containers.d', ['etc/dockerup.json.sample']),
 	],
-	install_requires=['docker-py>=0.7.0'])
+	install_requires=['docker-py>=1.2.0'])